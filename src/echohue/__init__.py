@@ -1,3 +1,5 @@
 __version__ = "0.1.3"
 
 from .main import Hub, Device
+from .registry import DeviceRegistry
+from . import color
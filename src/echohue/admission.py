@@ -0,0 +1,135 @@
+import asyncio
+import re
+from collections import Counter, deque
+
+# Request classes, in the order waiting requests are admitted
+COMMAND = "command"  # PUT .../lights/<id>/state
+POLL = "poll"  # GET .../lights/<id>
+OTHER = "other"
+DISCOVERY = "discovery"  # description.xml, icons, full listings
+PRIORITY = (COMMAND, POLL, OTHER, DISCOVERY)
+
+SERVICE_UNAVAILABLE = (
+    b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n"
+    b"Content-Length: 0\r\nConnection: close\r\n\r\n"
+)
+
+
+# Same routing as Httpd.handle_request
+def classify(data):
+    if "description.xml" in data or "hue_logo_" in data:
+        return DISCOVERY
+    if re.match(r"PUT /api/.*lights/.+/state", data, re.I):
+        return COMMAND
+    if re.match(r"GET /api/.*lights ", data, re.I):
+        return DISCOVERY
+    if re.match(r"GET /api/.*lights/(.+) ", data, re.I):
+        return POLL
+    if re.match(r"GET /api/[^/ ]+ ", data, re.I):
+        # the full state, asked for by every Echo on discovery
+        return DISCOVERY
+    return OTHER
+
+
+# Limits the requests that are handled at the same time, ADMISSION_TOTAL in
+# total and ADMISSION_LIMITS per class. Requests over the limit wait, freed
+# slots go to commands first and discovery last. Discovery requests are also
+# limited to DISCOVERY_PER_CLIENT per client. Requests are shed (answered
+# with 503) if ADMISSION_QUEUE requests of their class are waiting already
+# or if they waited ADMISSION_TIMEOUT seconds.
+class AdmissionControl:
+    def __init__(self, config, logger) -> None:
+        self.config = config
+        self.logger = logger
+        self.total = 0
+        self.running = Counter()
+        # running discovery requests by client address
+        self.clients = Counter()
+        self.waiting = {cls: deque() for cls in PRIORITY}
+        # per class: admitted, queued, shed, shed_client (over the per
+        # client limit), shed_timeout
+        self.counters = {cls: Counter() for cls in PRIORITY}
+
+    def room(self, cls):
+        return (
+            self.total < self.config["ADMISSION_TOTAL"]
+            and self.running[cls] < self.config["ADMISSION_LIMITS"][cls]
+        )
+
+    # Returns False if the request is shed, otherwise release() must follow
+    async def acquire(self, cls, client):
+        counters = self.counters[cls]
+        if cls == DISCOVERY:
+            if self.clients[client] >= self.config["DISCOVERY_PER_CLIENT"]:
+                counters["shed_client"] += 1
+                return False
+            self.clients[client] += 1
+
+        if self.room(cls) and not self.waiting[cls]:
+            self.start(cls)
+            return True
+
+        if len(self.waiting[cls]) >= self.config["ADMISSION_QUEUE"]:
+            counters["shed"] += 1
+            self.forget(cls, client)
+            return False
+
+        counters["queued"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[cls].append(future)
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(future), self.config["ADMISSION_TIMEOUT"]
+            )
+        except asyncio.TimeoutError:
+            if future.done():
+                # admitted just now
+                return True
+            self.waiting[cls].remove(future)
+            counters["shed_timeout"] += 1
+            self.forget(cls, client)
+            return False
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(cls, client)
+            else:
+                self.waiting[cls].remove(future)
+                self.forget(cls, client)
+            raise
+        return True
+
+    def start(self, cls):
+        self.total += 1
+        self.running[cls] += 1
+        self.counters[cls]["admitted"] += 1
+
+    def release(self, cls, client):
+        self.total -= 1
+        self.running[cls] -= 1
+        self.forget(cls, client)
+        self.wake()
+
+    def forget(self, cls, client):
+        if cls == DISCOVERY:
+            self.clients[client] -= 1
+            if self.clients[client] <= 0:
+                del self.clients[client]
+
+    # Admit waiting requests, highest priority first
+    def wake(self):
+        for cls in PRIORITY:
+            waiting = self.waiting[cls]
+            while waiting and self.room(cls):
+                future = waiting.popleft()
+                self.start(cls)
+                future.set_result(None)
+
+    def stats(self):
+        return {
+            cls: dict(
+                self.counters[cls],
+                running=self.running[cls],
+                waiting=len(self.waiting[cls]),
+            )
+            for cls in PRIORITY
+        }
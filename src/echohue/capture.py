@@ -0,0 +1,89 @@
+import itertools
+import struct
+import time
+from collections import namedtuple
+
+from . import serialize
+
+# Capture file: MAGIC, length of the JSON metadata (u32) and the metadata,
+# then records of HEADER (seconds since the start, kind, id, length of the
+# data) followed by the data. A response has the id of its request.
+MAGIC = b"ECHOCAP1"
+HEADER = struct.Struct("<dBII")
+META_LENGTH = struct.Struct("<I")
+
+HTTP_REQUEST = 1
+HTTP_RESPONSE = 2
+DATAGRAM = 3
+DATAGRAM_RESPONSE = 4
+
+# Hub config written to the metadata, replay uses it to set up a local hub
+META_KEYS = ("IP", "HTTP_PORT", "UPNP_PORT", "SERIALNO", "MACADDRESS")
+
+Record = namedtuple("Record", ["time", "kind", "id", "data"])
+
+
+# Records the traffic of a hub, see Hub config CAPTURE. Only used from the
+# hub loop, writes are buffered until close().
+class CaptureWriter:
+    def __init__(self, path, config) -> None:
+        self.path = path
+        self.file = open(path, "wb", buffering=1 << 16)
+        self.start = time.monotonic()
+        self.ids = itertools.count(1)
+        # id of the request that is being answered, by client socket
+        self.clients = {}
+
+        meta = serialize.dumps({key: config.get(key) for key in META_KEYS})
+        self.file.write(MAGIC + META_LENGTH.pack(len(meta)) + meta)
+
+    def write(self, kind, id, data):
+        if self.file.closed:
+            return
+        self.file.write(
+            HEADER.pack(time.monotonic() - self.start, kind, id, len(data)) + data
+        )
+
+    def request(self, client, data):
+        id = self.clients[client] = next(self.ids)
+        self.write(HTTP_REQUEST, id, data)
+
+    def response(self, client, data):
+        if client in self.clients:
+            self.write(HTTP_RESPONSE, self.clients[client], data)
+
+    def done(self, client):
+        self.clients.pop(client, None)
+
+    # Returns the id for the response to the datagram
+    def datagram(self, data):
+        id = next(self.ids)
+        self.write(DATAGRAM, id, data)
+        return id
+
+    def datagram_response(self, id, data):
+        self.write(DATAGRAM_RESPONSE, id, data)
+
+    def close(self):
+        self.file.close()
+
+
+# Returns the metadata and a list of the records of a capture file
+def read_capture(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not a capture file: {path}")
+        (length,) = META_LENGTH.unpack(f.read(META_LENGTH.size))
+        meta = serialize.loads(f.read(length))
+
+        records = []
+        while header := f.read(HEADER.size):
+            if len(header) < HEADER.size:
+                break
+            seconds, kind, id, length = HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # the hub was killed while writing
+                break
+            records.append(Record(seconds, kind, id, data))
+    return meta, records
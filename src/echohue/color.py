@@ -0,0 +1,348 @@
+import colorsys
+from collections import OrderedDict
+
+from .defaults import ALL
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, batches are converted one by one
+    np = None
+
+# Color representations:
+#   "xy":  (x, y) CIE 1931 chromaticity, clipped to the lamp gamut
+#   "hs":  (hue 0-65535, sat 0-254)
+#   "ct":  mired 153-500
+#   "rgb": (r, g, b) 0-255
+SPACES = ("xy", "hs", "ct", "rgb")
+
+GAMUT = tuple(tuple(point) for point in ALL["capabilities"]["control"]["colorgamut"])
+CT_MIN = ALL["capabilities"]["control"]["ct"]["min"]
+CT_MAX = ALL["capabilities"]["control"]["ct"]["max"]
+EPSILON = 1e-9
+
+# Wide gamut D65 matrices as used by Philips
+RGB_TO_XYZ = (
+    (0.664511, 0.154324, 0.162028),
+    (0.283881, 0.668433, 0.047685),
+    (0.000088, 0.072310, 0.986039),
+)
+XYZ_TO_RGB = (
+    (1.656492, -0.354851, -0.255038),
+    (-0.707196, 1.655397, 0.036152),
+    (0.051713, -0.121364, 1.011530),
+)
+
+
+def _cross(o, a, b):
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+
+def _closest_on_segment(p, a, b):
+    ab = (b[0] - a[0], b[1] - a[1])
+    t = ((p[0] - a[0]) * ab[0] + (p[1] - a[1]) * ab[1]) / (ab[0] ** 2 + ab[1] ** 2)
+    t = min(max(t, 0.0), 1.0)
+    return (a[0] + ab[0] * t, a[1] + ab[1] * t)
+
+
+def in_gamut(xy, gamut=GAMUT):
+    r, g, b = gamut
+    d1, d2, d3 = _cross(r, g, xy), _cross(g, b, xy), _cross(b, r, xy)
+    # points on the edges (e.g. clipped ones) count as inside
+    e = EPSILON
+    return (d1 >= -e and d2 >= -e and d3 >= -e) or (d1 <= e and d2 <= e and d3 <= e)
+
+
+# Move xy to the closest point of the gamut triangle
+def clip_xy(xy, gamut=GAMUT):
+    xy = (float(xy[0]), float(xy[1]))
+    if in_gamut(xy, gamut):
+        return xy
+    r, g, b = gamut
+    points = [_closest_on_segment(xy, a, c) for a, c in ((r, g), (g, b), (b, r))]
+    return min(points, key=lambda p: (p[0] - xy[0]) ** 2 + (p[1] - xy[1]) ** 2)
+
+
+def _gamma(v):
+    return 12.92 * v if v <= 0.0031308 else 1.055 * v ** (1 / 2.4) - 0.055
+
+
+def _linear(v):
+    return ((v + 0.055) / 1.055) ** 2.4 if v > 0.04045 else v / 12.92
+
+
+def xy_to_rgb(xy, gamut=GAMUT):
+    x, y = clip_xy(xy, gamut)
+    if y == 0:
+        return (0, 0, 0)
+    xyz = (x / y, 1.0, (1 - x - y) / y)
+    rgb = [sum(m * c for m, c in zip(row, xyz)) for row in XYZ_TO_RGB]
+    rgb = [max(c, 0.0) for c in rgb]
+    peak = max(rgb) or 1.0
+    return tuple(
+        round(min(max(_gamma(c / peak), 0.0), 1.0) * 255) for c in rgb
+    )
+
+
+def rgb_to_xy(rgb, gamut=GAMUT):
+    linear = [_linear(c / 255) for c in rgb]
+    x, y, z = (sum(m * c for m, c in zip(row, linear)) for row in RGB_TO_XYZ)
+    total = x + y + z
+    if total == 0:
+        return clip_xy((0.3127, 0.3290), gamut)  # black, use the white point
+    return clip_xy((x / total, y / total), gamut)
+
+
+def hs_to_rgb(hs):
+    r, g, b = colorsys.hsv_to_rgb(hs[0] / 65535, hs[1] / 254, 1.0)
+    return (round(r * 255), round(g * 255), round(b * 255))
+
+
+def rgb_to_hs(rgb):
+    h, s, _ = colorsys.rgb_to_hsv(*(c / 255 for c in rgb))
+    return (round(h * 65535), round(s * 254))
+
+
+# Planckian locus approximation (Kim et al.)
+def ct_to_xy(ct):
+    t = 1e6 / min(max(ct, CT_MIN), CT_MAX)
+    if t <= 4000:
+        x = -0.2661239e9 / t**3 - 0.2343589e6 / t**2 + 0.8776956e3 / t + 0.179910
+    else:
+        x = -3.0258469e9 / t**3 + 2.1070379e6 / t**2 + 0.2226347e3 / t + 0.240390
+    if t <= 2222:
+        y = -1.1063814 * x**3 - 1.34811020 * x**2 + 2.18555832 * x - 0.20219683
+    elif t <= 4000:
+        y = -0.9549476 * x**3 - 1.37418593 * x**2 + 2.09137015 * x - 0.16748867
+    else:
+        y = 3.0817580 * x**3 - 5.87338670 * x**2 + 3.75112997 * x - 0.37001483
+    return (x, y)
+
+
+# McCamy's approximation, clamped to the supported ct range. Its
+# denominator is 0 for y = 0.1858, it is kept at least MCCAMY_MIN away.
+MCCAMY_MIN = 1e-3
+
+
+def xy_to_ct(xy):
+    d = 0.1858 - xy[1]
+    if abs(d) < MCCAMY_MIN:
+        d = -MCCAMY_MIN if d < 0 else MCCAMY_MIN
+    n = (xy[0] - 0.3320) / d
+    kelvin = 449 * n**3 + 3525 * n**2 + 6823.3 * n + 5520.33
+    if kelvin <= 0:
+        return CT_MAX
+    return min(max(round(1e6 / kelvin), CT_MIN), CT_MAX)
+
+
+def _to_xy(value, source, gamut):
+    match source:
+        case "xy":
+            return clip_xy(value, gamut)
+        case "hs":
+            return rgb_to_xy(hs_to_rgb(value), gamut)
+        case "ct":
+            return clip_xy(ct_to_xy(value), gamut)
+        case "rgb":
+            return rgb_to_xy(value, gamut)
+    raise ValueError(f"Unknown color space: {source}")
+
+
+def _from_xy(xy, target, gamut):
+    match target:
+        case "xy":
+            return (round(xy[0], 4), round(xy[1], 4))
+        case "hs":
+            return rgb_to_hs(xy_to_rgb(xy, gamut))
+        case "ct":
+            return xy_to_ct(xy)
+        case "rgb":
+            return xy_to_rgb(xy, gamut)
+    raise ValueError(f"Unknown color space: {target}")
+
+
+def convert(value, source, target, gamut=GAMUT):
+    if source == target == "ct":
+        return min(max(round(value), CT_MIN), CT_MAX)
+    if source == target and source in ("hs", "rgb"):
+        return tuple(value)
+    if source == "hs" and target == "rgb":
+        return hs_to_rgb(value)
+    if source == "rgb" and target == "hs":
+        return rgb_to_hs(value)
+    return _from_xy(_to_xy(value, source, gamut), target, gamut)
+
+
+# Convert a whole batch (a group, or the frames of a fade) in one call.
+# Uses numpy if it is installed, returns a list in both cases.
+def convert_many(values, source, target, gamut=GAMUT, use_numpy=True):
+    if not len(values):
+        return []
+    if np is None or not use_numpy:
+        return [convert(value, source, target, gamut) for value in values]
+
+    values = np.asarray(values, dtype=float)
+    if source == "hs" and target == "rgb":
+        result = _np_hs_to_rgb(values)
+    elif source == "rgb" and target == "hs":
+        result = _np_rgb_to_hs(values)
+    elif source == target == "ct":
+        result = np.clip(np.round(values), CT_MIN, CT_MAX)
+    elif source == target and source in ("hs", "rgb"):
+        result = values
+    else:
+        match source:
+            case "xy":
+                xy = _np_clip_xy(values, gamut)
+            case "hs":
+                xy = _np_rgb_to_xy(_np_hs_to_rgb(values), gamut)
+            case "ct":
+                xy = _np_clip_xy(_np_ct_to_xy(values), gamut)
+            case "rgb":
+                xy = _np_rgb_to_xy(values, gamut)
+            case _:
+                raise ValueError(f"Unknown color space: {source}")
+        match target:
+            case "xy":
+                result = np.round(xy, 4)
+            case "hs":
+                result = _np_rgb_to_hs(_np_xy_to_rgb(xy, gamut))
+            case "ct":
+                result = _np_xy_to_ct(xy)
+            case "rgb":
+                result = _np_xy_to_rgb(xy, gamut)
+            case _:
+                raise ValueError(f"Unknown color space: {target}")
+
+    if target == "ct":
+        return [int(v) for v in result]
+    if target == "xy":
+        return [(float(x), float(y)) for x, y in result]
+    return [tuple(int(c) for c in row) for row in result]
+
+
+def _np_cross(o, a, p):
+    return (a[0] - o[0]) * (p[:, 1] - o[1]) - (a[1] - o[1]) * (p[:, 0] - o[0])
+
+
+def _np_clip_xy(xy, gamut):
+    r, g, b = (np.asarray(point) for point in gamut)
+    d1, d2, d3 = _np_cross(r, g, xy), _np_cross(g, b, xy), _np_cross(b, r, xy)
+    e = EPSILON
+    inside = ((d1 >= -e) & (d2 >= -e) & (d3 >= -e)) | ((d1 <= e) & (d2 <= e) & (d3 <= e))
+
+    best = xy.copy()
+    best_distance = np.full(len(xy), np.inf)
+    for a, c in ((r, g), (g, b), (b, r)):
+        ab = c - a
+        t = np.clip(((xy - a) @ ab) / (ab @ ab), 0.0, 1.0)
+        point = a + t[:, None] * ab
+        distance = ((point - xy) ** 2).sum(axis=1)
+        closer = distance < best_distance
+        best[closer] = point[closer]
+        best_distance[closer] = distance[closer]
+    return np.where(inside[:, None], xy, best)
+
+
+def _np_gamma(v):
+    return np.where(v <= 0.0031308, 12.92 * v, 1.055 * np.power(v, 1 / 2.4) - 0.055)
+
+
+def _np_linear(v):
+    return np.where(v > 0.04045, np.power((v + 0.055) / 1.055, 2.4), v / 12.92)
+
+
+def _np_xy_to_rgb(xy, gamut):
+    xy = _np_clip_xy(xy, gamut)
+    x, y = xy[:, 0], xy[:, 1]
+    safe_y = np.where(y == 0, 1.0, y)
+    xyz = np.stack([x / safe_y, np.ones_like(x), (1 - x - y) / safe_y], axis=1)
+    rgb = np.maximum(xyz @ np.asarray(XYZ_TO_RGB).T, 0.0)
+    peak = rgb.max(axis=1, keepdims=True)
+    rgb = rgb / np.where(peak == 0, 1.0, peak)
+    rgb = np.round(np.clip(_np_gamma(rgb), 0.0, 1.0) * 255)
+    rgb[y == 0] = 0
+    return rgb
+
+
+def _np_rgb_to_xy(rgb, gamut):
+    xyz = _np_linear(rgb / 255) @ np.asarray(RGB_TO_XYZ).T
+    total = xyz.sum(axis=1)
+    safe_total = np.where(total == 0, 1.0, total)
+    xy = xyz[:, :2] / safe_total[:, None]
+    xy[total == 0] = (0.3127, 0.3290)
+    return _np_clip_xy(xy, gamut)
+
+
+def _np_hs_to_rgb(hs):
+    h = hs[:, 0] / 65535 * 6.0
+    s = hs[:, 1] / 254
+    i = np.floor(h).astype(int) % 6
+    f = h - np.floor(h)
+    p, q, t = 1 - s, 1 - s * f, 1 - s * (1 - f)
+    v = np.ones_like(s)
+    r = np.choose(i, [v, q, p, p, t, v])
+    g = np.choose(i, [t, v, v, q, p, p])
+    b = np.choose(i, [p, p, t, v, v, q])
+    return np.round(np.stack([r, g, b], axis=1) * 255)
+
+
+def _np_rgb_to_hs(rgb):
+    rgb = rgb / 255
+    high, low = rgb.max(axis=1), rgb.min(axis=1)
+    delta = high - low
+    safe_delta = np.where(delta == 0, 1.0, delta)
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    h = np.where(
+        high == r,
+        (g - b) / safe_delta,
+        np.where(high == g, 2.0 + (b - r) / safe_delta, 4.0 + (r - g) / safe_delta),
+    )
+    h = np.where(delta == 0, 0.0, (h / 6.0) % 1.0)
+    s = np.where(high == 0, 0.0, delta / np.where(high == 0, 1.0, high))
+    return np.round(np.stack([h * 65535, s * 254], axis=1))
+
+
+def _np_ct_to_xy(ct):
+    t = 1e6 / np.clip(ct, CT_MIN, CT_MAX)
+    x = np.where(
+        t <= 4000,
+        -0.2661239e9 / t**3 - 0.2343589e6 / t**2 + 0.8776956e3 / t + 0.179910,
+        -3.0258469e9 / t**3 + 2.1070379e6 / t**2 + 0.2226347e3 / t + 0.240390,
+    )
+    y = np.where(
+        t <= 2222,
+        -1.1063814 * x**3 - 1.34811020 * x**2 + 2.18555832 * x - 0.20219683,
+        np.where(
+            t <= 4000,
+            -0.9549476 * x**3 - 1.37418593 * x**2 + 2.09137015 * x - 0.16748867,
+            3.0817580 * x**3 - 5.87338670 * x**2 + 3.75112997 * x - 0.37001483,
+        ),
+    )
+    return np.stack([x, y], axis=1)
+
+
+def _np_xy_to_ct(xy):
+    d = 0.1858 - xy[:, 1]
+    d = np.where(np.abs(d) < MCCAMY_MIN, np.where(d < 0, -MCCAMY_MIN, MCCAMY_MIN), d)
+    n = (xy[:, 0] - 0.3320) / d
+    kelvin = 449 * n**3 + 3525 * n**2 + 6823.3 * n + 5520.33
+    mired = np.round(1e6 / np.where(kelvin <= 0, 1.0, kelvin))
+    return np.where(kelvin <= 0, CT_MAX, np.clip(mired, CT_MIN, CT_MAX))
+
+
+# Small LRU of recent conversions, one per device. Lamps tend to go back
+# and forth between a handful of colors, so most lookups are hits.
+class ColorCache:
+    def __init__(self, size=16) -> None:
+        self.size = size
+        self.entries = OrderedDict()
+
+    def convert(self, value, source, target, gamut=GAMUT):
+        key = (source, tuple(value) if isinstance(value, list) else value, target, gamut)
+        if (result := self.entries.get(key)) is not None:
+            self.entries.move_to_end(key)
+            return result
+        result = self.entries[key] = convert(value, source, target, gamut)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return result
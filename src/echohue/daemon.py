@@ -0,0 +1,259 @@
+import argparse
+import asyncio
+import importlib
+import os
+import signal
+import time
+import tomllib
+
+from . import profiles, serialize
+from .main import Device, Hub
+
+# Config file (JSON or TOML):
+#
+#   [hub]                      # any key of Hub.config
+#   HTTP_PORT = 80
+#
+#   [[devices]]
+#   name = "Lamp"              # required
+#   id = "1"                   # optional, generated from the name otherwise
+#   on = true                  # initial state
+#   bri = 254
+#   profile = "dimmable"       # plug, dimmable or extended (default)
+#   class = "mylamps:Lamp"     # Device subclass, Device by default
+#   options = {ip = "10.0.0.5"}  # keyword arguments of the class
+DEVICE_KEYS = {
+    "name": str,
+    "id": str,
+    "on": bool,
+    "bri": int,
+    "profile": str,
+    "class": str,
+    "options": dict,
+}
+# Changing these replaces the device, changing the name renames it and the
+# initial state is ignored for devices that are running already
+REPLACE_KEYS = ("class", "options", "profile")
+
+
+def read(path):
+    with open(path, "rb") as f:
+        if str(path).endswith(".toml"):
+            return tomllib.load(f)
+        return serialize.loads(f.read())
+
+
+# Check the whole config in one pass, raises ValueError with all problems.
+# Returns the hub config and the device definitions by key (id or name).
+def validate(config, hub_keys):
+    errors = []
+    if not isinstance(config, dict):
+        raise ValueError("The config must be an object")
+
+    hub = config.get("hub", {})
+    if not isinstance(hub, dict):
+        errors.append("hub: must be an object")
+        hub = {}
+    for key in hub:
+        if key not in hub_keys:
+            errors.append(f"hub: unknown key {key}")
+
+    specs = {}
+    devices = config.get("devices", [])
+    if not isinstance(devices, list):
+        errors.append("devices: must be a list")
+        devices = []
+    for i, spec in enumerate(devices):
+        where = f"devices[{i}]"
+        if not isinstance(spec, dict):
+            errors.append(f"{where}: must be an object")
+            continue
+        for key, value in spec.items():
+            kind = DEVICE_KEYS.get(key)
+            if kind is None:
+                errors.append(f"{where}: unknown key {key}")
+            elif type(value) is not kind:
+                errors.append(f"{where}: {key} must be {kind.__name__}")
+        if "name" not in spec:
+            errors.append(f"{where}: name is missing")
+            continue
+        if type(spec.get("bri", 1)) is int and not 1 <= spec.get("bri", 1) <= 254:
+            errors.append(f"{where}: bri must be between 1 and 254")
+        profile = spec.get("profile", "extended")
+        if type(profile) is str and profile not in profiles.PROFILES:
+            errors.append(
+                "{}: profile must be one of {}".format(
+                    where, ", ".join(profiles.PROFILES)
+                )
+            )
+        key = spec.get("id", spec["name"])
+        if key in specs:
+            errors.append(f"{where}: {key} is defined twice")
+        specs[key] = spec
+
+    if errors:
+        raise ValueError("\n".join(errors))
+    return hub, specs
+
+
+class Daemon:
+    def __init__(self, path, debug=False) -> None:
+        self.created = time.perf_counter()
+        self.path = path
+        self.hub = Hub(debug)
+        self.logger = self.hub.logger
+        # (definition, device) by key of the definition
+        self.live = {}
+        self.classes = {}
+        self.mtime = None
+
+    def device_class(self, name):
+        if name not in self.classes:
+            module, _, attr = name.partition(":")
+            cls = getattr(importlib.import_module(module), attr)
+            if not (isinstance(cls, type) and issubclass(cls, Device)):
+                raise ValueError(f"{name} is not a Device")
+            self.classes[name] = cls
+        return self.classes[name]
+
+    def create(self, spec):
+        cls = self.device_class(spec["class"]) if "class" in spec else Device
+        device = cls(spec["name"], **spec.get("options", {}))
+        device.id = spec.get("id")
+        if "profile" in spec:
+            device.profile = spec["profile"]
+        if "on" in spec:
+            device.on = spec["on"]
+        if "bri" in spec:
+            device.bri = spec["bri"]
+        device.init(self.logger, self.hub)
+        return device
+
+    def load(self):
+        self.mtime = os.stat(self.path).st_mtime
+        hub, specs = validate(read(self.path), self.hub.config)
+        return hub, specs
+
+    def start(self):
+        start = time.perf_counter()
+        hub, specs = self.load()
+        self.hub.config.update(hub)
+        devices = []
+        for key, spec in specs.items():
+            device = self.create(spec)
+            self.live[key] = (spec, device)
+            devices.append(device)
+        # one registry change for all devices
+        self.hub.devices.apply(added=devices)
+        self.logger.info(
+            "Loaded {} devices in {:.1f}ms".format(
+                len(devices), (time.perf_counter() - start) * 1000
+            )
+        )
+
+    # Apply the differences between the config file and the running devices
+    def reload(self):
+        try:
+            hub, specs = self.load()
+            added = []
+            removed = []
+            renamed = {}
+            live = {}
+            for key, spec in specs.items():
+                current = self.live.get(key)
+                if current is None:
+                    device = self.create(spec)
+                    added.append(device)
+                elif any(spec.get(k) != current[0].get(k) for k in REPLACE_KEYS):
+                    device = self.create(dict(spec, id=current[1].id))
+                    removed.append(current[1])
+                    added.append(device)
+                else:
+                    device = current[1]
+                    if spec["name"] != device.name:
+                        renamed[device.id] = spec["name"]
+                live[key] = (spec, device)
+            removed += [
+                device for key, (_, device) in self.live.items() if key not in specs
+            ]
+        except (OSError, ValueError, ImportError, AttributeError, TypeError) as e:
+            self.logger.error("Not reloading {}:\n{}".format(self.path, e))
+            return False
+
+        changed = [key for key, value in hub.items() if self.hub.config[key] != value]
+        if changed:
+            self.logger.error(
+                "Hub config changes need a restart: {}".format(", ".join(changed))
+            )
+        self.hub.devices.apply(added, removed, renamed)
+        self.live = live
+        self.logger.info(
+            "Reloaded {}: +{} -{} ~{}".format(
+                self.path, len(added), len(removed), len(renamed)
+            )
+        )
+        return True
+
+    async def watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                continue
+            if mtime != self.mtime:
+                self.reload()
+
+    async def run(self, takeover=False, watch=None):
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+        except (NotImplementedError, AttributeError):
+            # no SIGHUP on Windows, use watch
+            pass
+        if watch:
+            self.watcher = loop.create_task(self.watch(watch))
+
+        async with self.hub:
+            task = loop.create_task(self.hub.run(takeover))
+            serving = loop.create_task(self.hub.serving.wait())
+            await asyncio.wait((task, serving), return_when=asyncio.FIRST_COMPLETED)
+            if self.hub.serving.is_set():
+                self.logger.info(
+                    "Serving {} devices {:.1f}ms after the start".format(
+                        len(self.hub.devices),
+                        (time.perf_counter() - self.created) * 1000,
+                    )
+                )
+            serving.cancel()
+            await task
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m echohue", description="Philips Hue emulation for Amazon Echo"
+    )
+    parser.add_argument("config", help="JSON or TOML file with the hub and devices")
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument(
+        "--takeover",
+        action="store_true",
+        help="take the sockets over from the hub serving at HANDOFF_PATH",
+    )
+    parser.add_argument(
+        "--watch",
+        type=float,
+        metavar="SECONDS",
+        help="reload when the config file changed (also on SIGHUP)",
+    )
+    args = parser.parse_args(argv)
+
+    daemon = Daemon(args.config, args.debug)
+    try:
+        daemon.start()
+    except (OSError, ValueError, ImportError, AttributeError, TypeError) as e:
+        parser.exit(1, "Invalid config {}:\n{}\n".format(args.config, e))
+    try:
+        asyncio.run(daemon.run(args.takeover, args.watch))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+
+from .main import Hub
+
+
+# Runs a hub in a background thread for synchronous applications:
+#
+#   runner = BackgroundHub()
+#   runner.hub.add(Lamp("Lamp"))
+#   runner.start()
+#   runner.update_state(lamp.id, on=True)  # from any thread
+#   runner.stop()
+#
+# update_state() calls from other threads are collected and applied on the
+# hub loop together, with one wakeup of the loop for all calls that arrive
+# until it gets to them. Later changes of the same attribute win.
+class BackgroundHub:
+    def __init__(self, hub=None, debug=False) -> None:
+        self.hub = hub if hub is not None else Hub(debug)
+        self.thread = None
+        self.loop = None
+        self.task = None
+        self.lock = threading.Lock()
+        # changes by (device id, source), in the order they arrived
+        self.pending = {}
+        self.scheduled = False
+        # loop wakeups, for the curious
+        self.wakeups = 0
+
+    # Returns once the hub serves, raises if it failed to start
+    def start(self, takeover=False, timeout=10):
+        started = threading.Event()
+        errors = []
+
+        def run():
+            async def main():
+                self.loop = asyncio.get_running_loop()
+                self.task = self.loop.create_task(self.hub.run(takeover))
+                self.loop.create_task(self.hub.serving.wait()).add_done_callback(
+                    lambda _: started.set()
+                )
+                try:
+                    await self.task
+                except asyncio.CancelledError:
+                    pass
+
+            try:
+                asyncio.run(main())
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                started.set()
+
+        self.thread = threading.Thread(target=run, name="echohue", daemon=True)
+        self.thread.start()
+        if not started.wait(timeout):
+            raise TimeoutError("Hub did not start within {}s".format(timeout))
+        if errors:
+            raise errors[0]
+        # updates from before the start
+        self.schedule()
+
+    def stop(self, timeout=10):
+        if self.thread is None:
+            return
+        if self.loop is not None and not self.loop.is_closed():
+            future = asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop)
+            try:
+                future.result(timeout)
+            except RuntimeError:
+                # the loop stopped meanwhile
+                pass
+        self.thread.join(timeout)
+        self.thread = None
+        # later updates wait for the next start()
+        with self.lock:
+            self.loop = None
+            self.scheduled = False
+
+    async def shutdown(self):
+        self.drain()
+        await self.hub.stop()
+        self.task.cancel()
+
+    # Thread safe Hub.update_state
+    def update_state(self, device_id, source="external", **changes):
+        with self.lock:
+            pending = self.pending.setdefault((device_id, source), {})
+            pending.update(changes)
+        self.schedule()
+
+    def schedule(self):
+        with self.lock:
+            if self.scheduled or not self.pending or self.loop is None:
+                return
+            self.scheduled = True
+            loop = self.loop
+        try:
+            loop.call_soon_threadsafe(self.drain)
+        except RuntimeError:
+            # the loop is closed, stop() is under way
+            with self.lock:
+                self.scheduled = False
+            return
+        with self.lock:
+            self.wakeups += 1
+
+    def drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.scheduled = False
+        for (device_id, source), changes in pending.items():
+            device = self.hub.devices.get(device_id)
+            if device is None:
+                self.hub.logger.error(
+                    "update_state for unknown device {}".format(device_id)
+                )
+                continue
+            try:
+                device.update_state(source, **changes)
+            except AttributeError as e:
+                self.hub.logger.error(e)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
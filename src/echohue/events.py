@@ -0,0 +1,103 @@
+import asyncio
+import itertools
+import time
+from collections import namedtuple
+
+# device_id: id of the changed device
+# changes: dict of the changed state attributes and their new values
+# source: "command" (sent by an Echo) or whatever was passed to update_state
+StateChange = namedtuple("StateChange", ["device_id", "changes", "source"])
+
+
+# Hub wide version of everything that is visible in the light listings,
+# bumped on every state change and on every change of the device list.
+class StateVersion:
+    def __init__(self) -> None:
+        # next() on a count is atomic, bump() can be called from any thread
+        self.counter = itertools.count(1)
+        self.version = 0
+        self.modified = time.time()
+        # versions restart at 0 in every process (e.g. after a handoff with
+        # the same SERIALNO), the epoch keeps their ETags apart
+        self.epoch = "%x" % time.time_ns()
+
+    def bump(self):
+        version = next(self.counter)
+        self.modified = time.time()
+        self.version = max(self.version, version)
+        return version
+
+
+class Subscription:
+    def __init__(self, bus, device_ids=None, maxsize=1000) -> None:
+        self.bus = bus
+        self.device_ids = set(device_ids) if device_ids else None
+        self.queue = asyncio.Queue(maxsize)
+        # events dropped because the consumer was too slow
+        self.dropped = 0
+
+    def put(self, event):
+        if self.device_ids is not None and event.device_id not in self.device_ids:
+            return
+        if self.queue.full():
+            # drop the oldest, newer events describe the current state better
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+    # Wait for at least one event and return everything that is queued.
+    async def batch(self, limit=None):
+        events = [await self.queue.get()]
+        while not self.queue.empty() and (limit is None or len(events) < limit):
+            events.append(self.queue.get_nowait())
+        return events
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class EventBus:
+    def __init__(self) -> None:
+        self.subscriptions = []
+        self.event_loop = None
+
+    def subscribe(self, device_ids=None, maxsize=1000):
+        subscription = Subscription(self, device_ids, maxsize)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    def publish(self, event):
+        if not self.subscriptions:
+            return
+        # queues are not thread safe, hand the event over to the hub loop
+        if self.event_loop is not None and not self.on_loop():
+            if not self.event_loop.is_closed():
+                self.event_loop.call_soon_threadsafe(self.dispatch, event)
+            return
+        self.dispatch(event)
+
+    def dispatch(self, event):
+        for subscription in list(self.subscriptions):
+            subscription.put(event)
+
+    def on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.event_loop
+        except RuntimeError:
+            return False
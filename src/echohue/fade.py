@@ -0,0 +1,130 @@
+import asyncio
+import heapq
+import itertools
+
+
+class Fade:
+    __slots__ = ("device", "start", "target", "begin", "end")
+
+    def __init__(self, device, target, begin, end) -> None:
+        self.device = device
+        self.target = target
+        self.begin = begin
+        self.end = end
+        self.start = {}
+        for key, value in target.items():
+            current = getattr(device, key)
+            # nothing to interpolate from, jump on the first frame
+            self.start[key] = value if current is None else current
+
+    # Interpolated values at time now, the targets once the fade is over
+    def frame(self, now):
+        if now >= self.end:
+            return dict(self.target)
+        progress = (now - self.begin) / (self.end - self.begin)
+        values = {}
+        for key, target in self.target.items():
+            start = self.start[key]
+            if key == "xy":
+                values[key] = [
+                    round(s + (t - s) * progress, 4) for s, t in zip(start, target)
+                ]
+            else:
+                values[key] = round(start + (target - start) * progress)
+        return values
+
+
+# Runs every fade of the hub from a single task. Due devices are kept in a
+# heap, every tick pops all devices that are due (within half an update
+# interval) and applies their frames together.
+class FadeScheduler:
+    def __init__(self, config, logger) -> None:
+        self.config = config
+        self.logger = logger
+        self.fades = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.task = None
+        self.wakeup = None
+
+    @property
+    def interval(self):
+        return 1 / self.config["FADE_MAX_RATE"]
+
+    # duration in seconds, target maps bri/ct/xy to the final values
+    def start(self, device, target, duration):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        fade = Fade(device, target, now, now + duration)
+        self.fades[device.id] = fade
+        heapq.heappush(self.heap, (now, next(self.counter), fade))
+        self.logger.debug(
+            "Fading {} to {} in {}s".format(device.name, target, duration)
+        )
+
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = loop.create_task(self.loop())
+        else:
+            self.wakeup.set()
+
+    # Stop the fade of a device where it is, e.g. when a new command arrives.
+    # The heap entry is skipped once it comes up.
+    def cancel(self, device_id):
+        return self.fades.pop(device_id, None)
+
+    async def loop(self):
+        loop = asyncio.get_running_loop()
+        while self.heap:
+            delay = self.heap[0][0] - loop.time()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            tick = loop.time()
+            horizon = tick + self.interval / 2
+            due = []
+            while self.heap and self.heap[0][0] <= horizon:
+                fade = heapq.heappop(self.heap)[2]
+                if self.fades.get(fade.device.id) is fade:
+                    due.append(fade)
+
+            frames = [fade.frame(tick) for fade in due]
+            results = await asyncio.gather(
+                *(fade.device.apply_frame(values) for fade, values in zip(due, frames)),
+                return_exceptions=True,
+            )
+
+            now = loop.time()
+            for fade, result in zip(due, results):
+                if isinstance(result, Exception):
+                    self.logger.error(
+                        "Fade of {} failed: {}".format(fade.device.name, result)
+                    )
+                    self.cancel(fade.device.id)
+                elif self.fades.get(fade.device.id) is not fade:
+                    continue
+                elif tick >= fade.end:
+                    del self.fades[fade.device.id]
+                else:
+                    due_at = min(now + self.interval, fade.end)
+                    heapq.heappush(self.heap, (due_at, next(self.counter), fade))
+
+    async def stop(self):
+        self.fades.clear()
+        self.heap.clear()
+        if self.task is None or self.task.done():
+            return
+        if self.task.get_loop() is not asyncio.get_running_loop():
+            # stopped from another thread than the one running the hub
+            self.task.get_loop().call_soon_threadsafe(self.task.cancel)
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
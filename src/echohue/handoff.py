@@ -0,0 +1,146 @@
+import asyncio
+import json
+import os
+import socket
+
+# Names of the hub sockets, in the order systemd passes them if
+# LISTEN_FDNAMES is not set.
+SOCKET_NAMES = ("http", "ssdp", "ssdp_response", "broadcast")
+SD_LISTEN_FDS_START = 3
+# Config that identifies the bridge to the Echos, handed over with the sockets
+IDENTITY = ("SERIALNO", "MACADDRESS")
+
+
+# Sockets passed by systemd socket activation, by name
+def inherited_sockets():
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return {}
+    count = int(os.environ.get("LISTEN_FDS", 0))
+    names = os.environ.get("LISTEN_FDNAMES", "").split(":")
+    if len(names) != count:
+        names = SOCKET_NAMES[:count]
+
+    sockets = {}
+    for i, name in enumerate(names):
+        sockets[name] = socket.socket(fileno=SD_LISTEN_FDS_START + i)
+    for key in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(key, None)
+    return sockets
+
+
+# Runs in the serving process. A new process connects to the unix socket at
+# path and gets the bound sockets, once it reports that it is serving the
+# hub stops accepting and drains (see Hub.release).
+#
+#   new -> HANDOFF, old -> fds + names, new -> READY, old -> BYE
+class HandoffServer:
+    def __init__(self, path, hub) -> None:
+        self.path = path
+        self.hub = hub
+        self.logger = hub.logger
+
+    async def run(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+        self.sock.setblocking(False)
+        self.logger.info("Waiting for handoff requests on {}".format(self.path))
+
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                conn, _ = await loop.sock_accept(self.sock)
+                conn.setblocking(True)
+                conn.settimeout(self.hub.config["HANDOFF_TIMEOUT"])
+                try:
+                    done = await asyncio.to_thread(self.handoff, conn)
+                except (OSError, ValueError) as e:
+                    self.logger.error("Handoff failed: {}".format(e))
+                    done = False
+                finally:
+                    conn.close()
+                if done:
+                    break
+        finally:
+            self.close()
+
+        await self.hub.release()
+
+    def handoff(self, conn):
+        if recv_line(conn) != "HANDOFF":
+            return False
+        sockets = self.hub.sockets()
+        names = list(sockets)
+        identity = {key: self.hub.config[key] for key in IDENTITY}
+        self.logger.info("Handing over sockets: {}".format(", ".join(names)))
+        socket.send_fds(
+            conn,
+            [json.dumps({"sockets": names, "config": identity}).encode() + b"\n"],
+            [sock.fileno() for sock in sockets.values()],
+        )
+        # until the new process is serving we keep serving as well
+        if recv_line(conn) != "READY":
+            return False
+        self.close()
+        conn.sendall(b"BYE\n")
+        return True
+
+    def close(self):
+        if self.sock.fileno() == -1:
+            return
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+# Runs in the new process, takes the sockets over from the hub serving at path
+class HandoffClient:
+    def __init__(self, path, timeout=10) -> None:
+        self.path = path
+        self.timeout = timeout
+
+    # Returns the sockets by name and the identity config of the old hub
+    async def connect(self):
+        return await asyncio.to_thread(self._connect)
+
+    def _connect(self):
+        self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.conn.settimeout(self.timeout)
+        self.conn.connect(self.path)
+        self.conn.sendall(b"HANDOFF\n")
+        msg, fds, _, _ = socket.recv_fds(self.conn, 4096, len(SOCKET_NAMES))
+        msg = json.loads(msg)
+        names = msg["sockets"]
+        if len(names) != len(fds):
+            for fd in fds:
+                os.close(fd)
+            raise ValueError("Got {} sockets for {}".format(len(fds), names))
+        sockets = {name: socket.socket(fileno=fd) for name, fd in zip(names, fds)}
+        return sockets, msg["config"]
+
+    # Tell the old process that we are serving, returns once it let go
+    async def ready(self):
+        await asyncio.to_thread(self._ready)
+
+    def _ready(self):
+        try:
+            self.conn.sendall(b"READY\n")
+            if recv_line(self.conn) != "BYE":
+                raise ValueError("Handoff was not confirmed")
+        finally:
+            self.conn.close()
+
+
+def recv_line(conn):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(64)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode().strip()
+
@@ -1,18 +1,32 @@
 import asyncio
+import base64
+import inspect
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import AbstractAsyncContextManager
-import copy
-import hashlib
 import datetime
 import socket
+import hashlib
 import struct
+import time
 import email.utils
+import errno
 import uuid
 import re
 import sys
 import logging
 import logging.handlers
-import json
-from .defaults import ALL, GETSTATE
+from . import serialize
+from .registry import DeviceRegistry
+from .events import EventBus, StateChange, StateVersion
+from .fade import FadeScheduler
+from .refresh import StateRefresher
+from .pool import ConnectionPool
+from .capture import CaptureWriter
+from .admission import SERVICE_UNAVAILABLE, AdmissionControl, classify
+from .color import GAMUT, ColorCache, clip_xy
+from . import profiles
+from .state import LightState
+from .handoff import HandoffClient, HandoffServer, inherited_sockets
 
 M_SEARCH_REQ_MATCH = "M-SEARCH"
 
@@ -102,7 +116,7 @@ Connection: Keep-Alive
 
 # 20150920-Added in case it is used for discovery
 APICONFIG_JSON = """
-[{"swversion":"01008227","apiversion":"1.2.1","name":"Smartbridge 1","mac":"%s",}]
+[{"swversion":"01008227","apiversion":"1.2.1","name":"Smartbridge 1","mac":"%s"}]
 """
 
 NEWDEVELOPERSYNC_JSON = """
@@ -114,6 +128,10 @@ PUTRESP_TEMPLATE_JSON = """
 [{"%s":{"/lights/%s/state/%s":%s}}]
 """
 
+# GATEWAYIP, MACADDRESS, IP, HTTP_PORT
+# Everything of GET /api/<user> after the lights
+API_TAIL_JSON = """{"schedules":{"1":{"time":"2012-10-29T12:00:00","description":"","name":"schedule","command":{"body":{"on":true,"xy":null,"bri":null,"transitiontime":null},"address":"/api/newdeveloper/groups/0/action","method":"PUT"}}},"config":{"portalservices":false,"gateway":"%s","mac":"%s","swversion":"01005215","linkbutton":false,"ipaddress":"%s:%s","proxyport":0,"swupdate":{"text":"","notify":false,"updatestate":0,"url":""},"netmask":"255.255.255.0","name":"Philips hue","dhcp":true,"proxyaddress":"","whitelist":{"newdeveloper":{"name":"test user","last use date":"2015-02-04T21:35:18","create date":"2012-10-29T12:00:00"}},"UTC":"2012-10-29T12:05:00"},"groups":{"1":{"name":"Group 1","action":{"on":true,"bri":254,"hue":33536,"sat":144,"xy":[0.346,0.3568],"ct":201,"alert":null,"effect":"none","colormode":"xy","reachable":null},"lights":["1","2"]}},"scenes":{}}"""
+
 JSON_HEADERS = """HTTP/1.1 200 OK
 CONTENT-LENGTH: %d
 CONTENT-TYPE: application/json charset="utf-8"
@@ -121,8 +139,17 @@ DATE: %s
 EXT:
 SERVER: Unspecified, UPnP/1.0, Unspecified
 CONNECTION: close
+%s
+""".replace("\n", "\r\n")
+
+# ETAG, LAST-MODIFIED, DATE
+NOT_MODIFIED_HEADERS = """HTTP/1.1 304 Not Modified
+ETAG: %s
+LAST-MODIFIED: %s
+DATE: %s
+CONNECTION: close
 
-%s"""
+""".replace("\n", "\r\n")
 
 
 ICON_HEADERS = """HTTP/1.1 200 OK
@@ -134,18 +161,61 @@ ICON_SMALL = b"iVBORw0KGgoAAAANSUhEUgAAADAAAAAwCAYAAABXAvmHAAAAB3RJTUUH3AgNBw8Dc
 ICON_BIG = b"iVBORw0KGgoAAAANSUhEUgAAAHgAAAB4CAYAAAA5ZDbSAAAAB3RJTUUH3AgNBw4nVfRriAAAAAlwSFlzAAAewgAAHsIBbtB1PgAAAARnQU1BAACxjwv8YQUAACA+SURBVHja7V0LeFXVlV7ncZ/JTULCKwGCgYCAgiAPFakKVfA5tqjVftNqq1OnOuNX/apfR7+pM/aztR2tdpy2VltHnaqttp3p2LG1zqhVUVBBCwooLwNEMEAgCUlucl9n1trn7JN9z93nce9NVOhdfJtzzr5nr3PO/vd67LX2OVGgdNIXL168UNf1ZaqqzsfjViwTFEVJ4DYknoh1ZVzm6CXDMJzHWdz0YenAsh2PN6TT6Rd7e3tf3LBhQ18p1yi655csWTIdAftqLpf7PB6OA4bfEBsnmBVw3ckJsLOO7+O2FzdPoSA9sGrVqheLuUbg3l+wYMGUSCRyOwJ2CV5IZ40t8LxArADsTTKQxd8EkNkGBevVVCp1yxtvvPFSEP5Bel9Dqb0RGd+K+3ECzE1iZWBWAPYmiZqWHotbLDns15/39fVdv379+i4v/p69P3fu3DGxWOwJZHYG18MiwBUJLp/8JNi5FaQaN0YbSvPF69ate9ONh2vvn3TSSdNQFf8Bd6dyUGWAViS4PPKywzJpdqptss/Yx5etXr36aRl/VVY5b9488ohfAAtckYoBrALuyJCjX6vRfP4GfaQLpOc6KxYuXNgQCoVW4+40zkyUXDfAK9JbOnnZYRevWuaA9eN26Zo1a14XeTkRUBYtWvQHBGa5YpJZWVHPI0pBAebHEjXN9lGSd+NmHnrYnfx8XWx8yimnXMfBpWMnwF7qugJw6VSKHRb3+TH6TBNxcx+Wz/HzbQTQ7jZpmrYZT6pxU8sV9TwyFDTgIe6L4DrqiM5Hz/r3VGdLcDwe/yZuamRToIp6HnmSSSrvQ5k6doIr1ClY7sDDZ7DkGIf58+c3IrMdWKJuwFbU88jScNlhLsVojz/z1ltvPcUkOBqNXkXg0r4TOLegRiW4MbxUSsBDVmcdKwjwtbh9iiGBc6iNCMqsivR+fFSuHXbWI8AZnO5O1E8++eRWdK5m0g8y4IoNTQb5vUJyCirFsn3x2Co6lnN1RPp0LNI4s5/3LPvNra5C/jTMdph2T9dReue7ec7FAsw9vwrApVEQgHkfo1AW1DtBxnPm6dlsttVNDZciwRVwS6fhlmAsU0mCx1NlqQCDCLbs9woFphFQ0VVkiBOl3sy33t4O1VlTVTw+eTysq6+pgFsGjQDAQACrBIoYOQlyI6jaYexgGmosgMOpdFE8KjTyRHjofp6zm9OUyWQAx0n+ccXJKpmKFbCg59I0ydf+ugEs4MskmniJ/CoUnIY70MELOVme4Ug3R0vFdiLR78RLs+orIBdHw5UydNbrJIle8WcZwMwGkwQLlMO6jFBXAbg4GgkHiwGM5JkSlIFNDdPpdN5FVVUhZhAKhfLaV8ifylHPbvu2F51KpQrsrJ8UU+OUA+AcetMEungzFYCDUSnSK+57xKNBJ4kTQ5NekizWZRwqWtVUCIfDTIpFqoDsTV4JBvH3YkAV63WuaoM6WnzOTJIvEkkw1fEYqUgVkOVUjGoWj4N4z7YEcxtM5CbFMoBFW0tEEkx1TgkW21con0qVXq/fpF40UdBgB986VbRogyspRG9yA7ZY2yue57YIT3fOW72kWARJc8yDVVVl0ssl2A3Qv3SgSwWXbwMs18lX0SR1BE6xEpzN5ttasr0Uzaqs2XKnICs2ZOcVK72uEhzUFjv3+TENFCrOehn9pYHsZro4GOIU1BlU4r8798U6sZ4XOta51DlBFRMHIjP7dygcZW6xaDpTxd81xYAMIB8siuPBSiEV+Wmq9doGbrI5tWReQ72EPDUuAeRblMeTAcAlCoWJ9hTqc/Phi1LNQfadUyVdekPgP2L8PMBafIiFqR44PtcLLVoS6kMpnHSjGkfnuwvt9G41Bu/kEvDq4CjoyoWK/pYEXf+ixbvgiuVt7IsgW/dVw/U/OLFszTBrdid87subII0WqG9Ag3tuWVwyT71lAmSnTYXexmborRsP/aEEJCEC6YEsaJ0HofqDNhi19S3cbrMHgQxcZ50bZrJ63alSRXJbZcm2BSebv43FufDKfftgMYIbjuKFY/hbFCy5Nd9XHaukYayeggWhLvhCzW54bqAenjw8EfqMcODOM7VF1pRglfibPoA47SuWTD8ig2bGYPdJW5ot8GBQEKJOjU8bD7Gl8yHdMA56jRjeWRTro+bTGypkYjHon1gPnRNmQNu8FRD7cBc0v/Y0jN2xjvWRTP3yvnf+5nz7wYkbmyaJIMvsr/OYqWPnqMHD5R0H4QsdByAawQMCN0CfhLATz645AItqD8FdH7bC1sFqCNKQwMwI4VICJ+VwGIsl4ikGcHhAR8y4eRJ2Y9N5x0H8hGnQD3FIG/5NiJL1TfDesi9BR+vJMP3FRyDU3x14DuybTZJNa7xCl3yrKvmSf0nnYZicwrlxeIhPGi/w+gDA2j6AHVlUeYYCcbzcMXGAhaMMWDLWAC6zDVoa/mnSZvjWBzNh60ANeHnj9igGo6AuMBgSMjunEBWZ8yh2JtvHf5MvOhaqjp0AgzDEZvDDfdC9bhP07fwAMl09QNZXbWgEreU4UOaeBkZijM2ja3wrbFr+NZj53H0Q7essyQY799k0yS9yJYtkkSoTu2JyOmsvwEvjL4+lDHgkacBBxcwR804yMgas6s/Bwx9mYcy2DNx0bBYuaDY5RdUcfOOYd+H692ZDd2ZIXcsAI2lzqrAcSbUj/VkMmYsWjII6vpjBFVzcb/70RBg1owFSHNhDPbD53x+HzrXvoBlRWR/o5NXSfb73DoRefgYij3wfBuecCgMXXg25+omsXSZeB+8vuQpanr0btHTSM+7sdizW6zzkWGxOmElKOGS6rwJ16gZ8DX3ld9UQRONRGB2N2kkIMQpGqm9gYABueTcJ2wZTcMNs9L61HNRFsnDllHa4d/s0z4gYk1j6mpMStux/yOzEMmwwkaqSBgizsaooagFPmUMTGxOG5iWNkKbBjHq6/4OD8Pq3HwPoT0FDfT1EIhHGg2sBGjAkWIODgzCwZS0Mfu8N6Lv4BsjO+zSaLBSgRAPsm3shTFz3K1dgnXVuKUWdLuIGpJctZkkKcj6E5x1AhtcoSdiFoNZWVUEMnQkaQFxt8rYEOD00Ffr94bbDcExdGi5qxevoWTh9fA88uasH2pNxVyDo+jlDsQHGR2EDR9RIxZIpqcAAxn7GojB+PKUqI+rEmadPYADiBAtS6CGvuesJ0AazUF1bSy/25YFLRNqAnp1+o9LX1wfKE3fBgB6G8MzFENIU6J98Ihze9DxEuvfmgekHrFSC+cXd8sIyCU6TKkSgRIB/lhuAPbEqGF1XR+8b2w/m9SZEdXU1e8h7txyCFVMzkNA1BvK5LYfhoa21noESFbUEqGHTi1ZD9oKDILFwmSSaNhzv2ZJg8jOIHw1IN18gVKVC06xRkFF09JY1eO93a0FL5mD02LFsgDtDuuJ1CWjqJyqRnh7ofupHoEw5AQGOQVZDTTB9CVT/+bcF7YJEtvhW516j10I7GchpasccNPM4icx+gzdcVVXDOoVuXmbfZZ1EHdidjMJvdybh8jmoDrUsnNLUD/dtSIImyU6x6zMJNqXNlGCN1ZXjZDEJzhq2BCs+Ekz33jivzpReQyPnA7Y//w5UIWB0H6RRnEkZGRDEmwZDqrsbUmufgfDilQzgVNMsSK75JdMkQYGVSrCbM+UFMHNmWN+ax29kB0GNJCCRSORJUZAwJ/cDXtyXgyvQhmPvwJi4ARNrDTiQcp+DqhpJcNaSYEp2uEtbEKJn0pDHkAQrnhKczWShsbUWnSiUXgR436Y9EEGNIvaBm20U66zpDDvu2roOQp+6GLtAgUx1LQB62aHB7oIwpIyf7Ddpwj8I0ExFh6LMESHakhpkN8kl1w9cp6omVf5eN9owRCusoyFEgZiUSMKevXKniUlwbsgGmwClsb50J4sAzmWHbLCC/3GHUKbiM+kM1E+oAg2dqxz6AAe2dhT0gR+4IjDM7BzYjTPNHORo1kFSHB8FyuH9BQNCdiwF2OkABQGXiNkWnTrXBPigoaPjMOQt+4Hq3CeAB8Ix+BCdlMk1WIfsx1WbUyunHbMHBZNgzQRYAXbtclQ0ES0HZhKsAgPZzTNnU0UcDYlR6AiqpopOdvbbjqWb9HqBTW2iOLPQB/vACFWBigM4F0vYz+QnvbIBoDvnd0HAJqJls0ocH1zVrGPVmh9niwbXBgx7tDeHoGkKk2BdK1zIx9uY82BBgpWcPWctxwYb3IsGE2CRpxOQbM4MY+bIwcKSGczYfLyAdQM5Z7rwEKLPRqP0UvIkCaa2YjGEIiTXBtgtveclyXY92SYLYHVQZwDJFugF3WdeNz6YgoUiAoaStqXbSeY1dOY9MzSUrH1uObFohc+DAay5cFr6TLwjyf7SfJw8aF3ThwI6HkkbcV+s49oqEq8GA/syixI8kEnlXd/ZXuQhS0nqzvSeMzUoNhKljcWiyTnSLC+XPVQubzT52WBpeozULk2VNBM01xQkXYd5V1yC6d2oTFmvzpipPYWpaC7BhpGSTqn4fWk0yNgUSWcOJ0+beqX+3OqYFkuMQoDjkEtnmQTnevbbzxTEqXJeUxdBDQJyXtaCbE0ewFnXEerMM8sS1Wxfs3hq1NepwmuK4NEoUMO2DUY3qSRg8wk1APJUmLYsXCGa16EGl2CNTdMU2TmStm7gskzUsfMhrJnSq2YMSHXsRFdHd7W5bmQ7WUGCAtJzqIQRDD1kAwxZ9/PdqOBcUrla2JJgskBZ6eAzG5ODFbFUNFUMlAiq+FyoYpGnGckaAljeoYYtwQxgj4Er6/yCAYDn1516DoSxL3OqAV27NuOYRRUdCbny8uvXPCfLK7fo3LJ2obCpptnN5a/L8swlSwYQV21M5SPAwADGB82lpWutmRqkXJQ9TSpU50EGmtPJYatN7FBlzuYpuz6ZKW6DSRmaizeMgu9nuAHrlN7aFZdBVeNk0DNZNgU8sOb3QnIn68lD9jwMYC+nxBMkakcSHDKzPqRWnU5OUA+a77NCKlo3AaaOU5SU630oKMGKypMNmZKcLPFcc3CozAbT6h8FfQDOzzn42bUoGaHwmYRmn8udLFkbWT1Jbu2Zl8CopZ+FUCZHb+XDofc3Q8/GNVCTSOQ5mcWoamaDuQvu9tCyjmUjikJwZIPDQxIsTg+CgFzAk6YpmqWiUZCxu0H29iOR+QK6YseiyePODkO60MjpQ9MkNWuHGwtAse6XSTDdLElwNme/CB9k3ktuemL2Ihh97mUQbTwGHyoLIZr7DvbD2w9+h6UZ+bP6geomycqcOXN24rbZDVg3gCkLVZNKQwq3ND1IRdFuxWMgW2ftBrB4zHlGc/1odpJsumTocYBwNchSmmx+nO1FuelnAYdQOA4D6SqWuCgH4FS6F6/dh/wzyCsGA/0xqKqqYr+3zqqBcJTCkioraZS2i687C6U9ju5dBF548lXo+rCHBT6ydA4OQNQB5tY6puCQXjcawpOmQmzmPNCr6hiwZkHV3tMDr95xA/Tv3gI1NTV2mLRYyeXE0oVeNsuts6gz2geS9pKWOHp+8bRuS7GfWnbWcYno6E1DMmlqlerqLFSpGenD0Ll9fRkspo2OxdKQSGRdEwOyOayTiE+yPwu9vabURiIp5BlhPKnNhV9sgYbxCcgYUQQsjuDFsIRx3/Siz7j0TNwPM7BTuB2EEAwaIUjiNmWVtKGzkgFzEBiUMTENPnSiWn7tzpshdWAvy7LRNcVATzGSawNMeckgXrMTDJIqnjUS32rwcqT8QObvNlGwngc+nLlUUVXSb5RqI6JBxlOf5cyDiQ9pAR4f5zyZKUNQNFTfhoIaxSCtYqpmVDV4Pu1rzC+gLUk4AZillCOQTbZcfbo3w0zRaIbCVsV07d4BG594EHY+9z8QjYShrq6O3QPXhsVOjfIAFiXYC2QvR4wF3nHEe0mvn10XiYMkC9o7zxXj1OUk+8VOEgcUt6nUT6lBvAaWDK3BRmjI59YjOlPJ6Dzgb2iDcxmmlrPmNNkKyNAeedbYP9kUJDu7YH/bTti7cT20r34JOrdshJCu24sA+IByPrsXkG7gMxuMndLs9sBeedyvnzAf4iFzTfN/t+2Adw51lgSwePzlM1qhqSHGprh/2tQBr2zc79r+1BNHw7JTxjEna8+BJDz4ix1lAzxlagLOvqCZTXkGU1n42Y83MaRoedH+/QfQJPTaTlQorMMvXrkXR5mpqm+/5rvw9mtv+16De9o8kSGucHEmNkqRWvE3JsFea6PdOpek6/RJk6Euyj4zDav2tIObPQ+yz3kumDIGZrXUMc23raMHnBpGVNETx8fgrCUT2ZRq045D8KOHNpWtohM1dbDktAlMAvuTWfjh999kPEk7RaMRU8NyD1UFNk0Ca5oUDkeYQ+Z3fSfA/OM13OYGBTOIo6XLkvN+QFNj5niQdxu2Vj+q+am9YgG2k9mqbkeycqDYtthJbPWFodihStMGQsmL7oZiyEPZJJyk2baegyEGMTLZNJsmgTVNopUc9fX1vktsRZBl91qO1Dp/193mmV4g85GmhHQWjybKWHNQt7ixn9NlDxp6aDYXJp6G63c/zPkpBYxDDGDK5si+N1IMmasdM+jQhsz3qZBPKjWYBwQHjzmXVqCDbLBiBTr4EuEgcWhZUsIPyGLB13WXNU9+ncQemuZoER7J0vIWiPs5aTKAWR1JpBYxw8zqUHRMdn85GIpFq2q4rHQhd65Uio5RLJpdQzMjWxZP50DLGVlLgjUTYEXNu1+/XHA5wAX9XXdLkHt1kh1vpUSDFaokyZOl6oIec54s5GmFKg1FzYvtikR1vf0ZO1RZW5soeEe5WKK2kWiYhSq5BLvxZFqMvs+ZpW7Ae0YTEauKey6Qdx4HTR6UA74qxlrdkvWuv4fNUCUrAfn4khWqZEXV3N1/5LWn47CVbAhD47h6iMdC/vx9aOzYOivZEDYHD7gPdnoLouvAYdBRijW816bmJl/+Yj+49W1RGPjw8X351Wt0mOCGWQEfT9y5ItBZb5PtZIXNdKDsHIu2bN9nBh1UWgsWg+OPm1AWuHSNmbMm2gBTkfWBuHqibWs7nqczkGedMCvPCXNrF0Qiy1XZdndyQ+9VeMrMWc9ShWGz0BITt/OC8LPTcnY2KWylC3Ou5YMPu+D99h5TihHks5fNzvsoajHFVM86LDpphi294RC9leB+D0Qb1m1GcDW2snLO/LkQr66y35vy67+g/VwKL15U8cUwv2KLPT8WJFgV+DjP8+OX5xzxbBIVwclyns+mLWivn3l+o62mz10xHxrqq31Vn1tZufJkqK5O2NIbDsehOhEvVHvClHD1n95A460wZ4sCFedcfL7r+UH71eu8oFjZhYcYiym8jRIassEsYyI5Lyh/tiaZpIJAtWww58n5OAvRo0++zIL9pFar4tVw0/V/xaZWbm3cSkvLWLjyqhVgvngWttV0Y2O9axuSkEOdXbDq+TXMBpMkX/j5i2D8hMZAz5vXP/jsF3zlOmiaMq2gz4rpR2dReYC/2MICGmR7raKGvM/lgQI/nmwObKloVR1qK2tPEtOxvwce+9UrthQvP3MBXHft+UU9y5w5U+Bf770WorEqWz2rFsizT2gtuDY/pr6j2PEjP36UBahpTlwVi8E/fO82GNc43vM5xeNYvAquuPk2WLbyUrjxngfg7EsvtxMvQfrNs3i9Oedl4JkE6UMrOnJW8EM2pXEjZySLhem4BKsUvFALgidiO57J+vadv4BlSxfCpAljWCjxqi+dC1OmTIS77vk17N69zzVaNHbsKLj88hVw0cWfYiaGX6Xn0GGoqUswD/S8C06D3zz5J5C8YmTf1873d8FDP34Err7hWrbSc+KkSfCd+/8NHv7hT+DlZ59z7RO693mnLYXPfOVaGNs0iX2nQ42E4FNnnw/P/fZJGBzoLzu2rpfyLo89Zw0PrejQrPShW+DED2g7vssdLNV898iLJw9OHD58GC7/yh3wX098F+rqqhnIy85YAKefdiKse3MrrH1zCwO6ty8J1VUxaG4eD/PmTYO5c1vNhQWMl/mq8wP3/xrWrt0EP/nprWyVyrRpLfAvd38dnn1mNby+5m1IJgfz7oEvRviPB34OU6dPh+XnnwM5dA4bGhrghn/6Jvz1V6+Bda+ugbZt2+HQwYPsnhvGjYfmY2fCcSctxoHUAGy1PUs4GbB/bzvccf3fQmogWdZ7VjbAbulCP4DZW4lCLDprpdScn0YshicLS/Jpkmp2OPEUlwLJ2tEAePe9XXD+yhvh5w/dDi3HmPNRsiKLFs1mhZ1rAUmUsyoMa9ufHIBbb/0hPPbo09hOhQ3rd8CcuTPoSeCUU+fDyacugMsvuwl2bN9dcH3WkXgPt1x/M3R1dsOlX/oirc1kPsS48ePg7JWfZfs5qy7H8sCqueTIMNdi0z28/vILcMeNX4OBvl6WtBiOP48gTfgHAYPNAyNDoUqSYOIle48oCOB8Xsm8Z80KP2rhgq8DyNrxl8zbdnbAGWddDV+//gq46sqV6BGbiwEMe8GylW+n+7H6dQAl8le/fgbuufth2L//ENTW1rJTr7v22/Do43dDc8tEBgS9JkNv/zuX0IiDjLTJ9277Drz0/Itww83fgGnHHUerrFl+2GAAKxYv89gccAps3fgOPHzvPfDSH//AbDoteKC+LCczZgNcqg1m781iu0GrbTqXs5fveJEXUNQ+haI1mDNRSHt8oljkxVU1dU4ymYTbbr8P7v7BI3DeeUth6RknwezZx0Jj03ic14ZYMmF3+x748/rN8NKLr8Mzf3wJenp6WYfSi2O0pevt23cQzlnxZfSsL0M7fBYc0zIZB8MAywvLYuPUhsAnHmtWvQorl58L8xYsgKUrlsMJCxZC85SpOOWqYSOsu6sbtr23Bd56bQ28/H/PwuYN69kA4W/8E/9yFg/m9dHs2bPtRXfFAEyqs6enh3UoX2ZDasUPYDewOcDEs7+/31qTVc34BrHrXKvQwCMQ6P74dMkcIOYgoPCimI/l7/9Sx/LlOfz56NMKxIt/K4ukm5YIueXPecCEf3+EttzxFNWtndiwljqJCX/n257lkl7KMhfemXzUcVUi+/JNMUSdwHnyYIaX/ZURl2Tiw+ePzsXrYuc6E+78emwhofUZCvGDrbIv7jiJ59hpy+evYmqQDzDn9XkfDCfppXi9fATyTuEdUq7N4KCSmuM8S33flzp3KImfH9t1Rs9k/MXlNLzTxYiSsz9k7amteA8iyZI8I0Gu6cIgJPvASDkSLHYiJ9n7y8Xy8yK/e+aDzu1+/MjZvpR7KId0vw44EqmcNVkjxfvjouL18xFAIyUNRyLpwzGZrtAnl3S+mr9CRyeVNE2q0JFBbCpbVVU1qWKzjk5iAONW8VpNX6Ejl6y5/FHpSFcI7L9lpbOYa4WOLiL1TLF8Et/+aDQar9jho4t4rkDv6ek5EI/Hm9lHqSve9FFDFAenbJa+Z88emDlzJquo0NFDlFFrb29nEszWNFEF5WErUnzkE/+0xr59+8xY9K5du+D4448XkuMVOpKJ0q2EKftDYVRB9pfQHj16NJPmihQfmUSOFS1SoFU2HR0drE7nyWZCnL7LRMtu6IQKHXnEv/Hx7rvvsuO8twtJNW/ZsoVNjvlKhAodGSQuOty+fXuegGqI8g1Y2FpRssGkohsbGxn6sr8YUqFPHpFTRUGNnTt3wv79Q3/fwVyGrGltuD9ZbECqesaMGfbqwIpN/mQSD2ZwcGnKW/AFBTxhE25nOhtTIwKZGpBUF7u6sUIjS4QLYUTmlNQyOcm8Pu88POE5tL/LZAxI9KdPn84kmq8RPhrXcB1JRL4SV8mkYclv6u3tzTtH+ETEgIJzpp+irf0bJyNxJIwbNw4mT57MwKVgCIFdccI+eqL5LX+5YO/evUwty+IWwiefNtGH0N7yUr90Mon/wYMHoampiTlgJNG08p99v9F6tWQk1/b+pZG4jJZUMH8lhoiw2L17N9OmRF5fMULzu15B6Ty+u7t7A0CQv9dt5hjp1cgxY8bAqFGj7LCY6HG7fblHtuBc9lsQHl5fnnH7ko2sE52f1Xf+VmqRfUeDS5vbNzbED7jwhfckfIgP844JXK+ZjfPLOzgv/juqUROJxDZs2FLsSCMmFDkhe8DfUgza0cUAUww/8UGdW5mkuG396twGiFd9kLb8mDQjmUKyr17hYzcJRgHJjh49eir7g9SoAn6JTG4uFmAimlTzifVI2uW8r+EFOHc4KMjzFPPMfufmvQiv5P/BrGKeleoQ09VtbW07WSwapfBBlOCbEOSy1u+MtONVjAf/UYAcdMA5eck+i1gsL6/nxDoDbfb9bJ9Xoi1+HA3350eqM0qlYh56JJy84fog2XCT27NSPdruHQcOHKDPE6RtiUUp/meU4s+iFEdH4oa8Pkk4nKN3JGm4VfZwPqvwu4FY3grsz1U7POdJkyZ9C+3pP0IAj5qD4qZ2PsqHK6WtbFANpz0dSfISimg0+nx7e/uZYH1+xHlGCEF+Bee3Cz+2u/d5MKJSJX44qBxgxft2+652qX1ChFOrg+hcnUjOFa9zOlVpPOkSPOk1nH+NG8lOKhcscRSPFODlSqkboEGeqdi+wJLBqeoXduzYsTPvN1mDlpaWhQjw/6I9rh2pjhppCQzyVR9+3kiYmeFW4V7Pg79lUSiv2b59+08LfnNr1NraejI6Xb/DGx3t9yDFjFK3mx8ulfVx0Edhjz2kO41e898juA9I23kxRUmejgz/ExnP8ju3QsHITQWLWiQo4bmHcENq+feu5/gxwflxVU1NzZ2orq8G84++VujjJwPBfQE17JWiQyWjwMNl6tSpp6iqeieOtMXFtPs4yfkdLrHOy+6Wa3JGkOiG2rB8c9u2bY9bx959UOwVpkyZsgx1/rW4ex6WiGEYn0iw3ea4QcAbyTl9iUTZhtV4X/dv2bLll2AFMQL1Q6lXbG5uHoVu+Qq86FLsjBNxOx2raz7unjgaCPtzAPtzB+6uR9O4ClXx036q2I3+H6KpdSN3OOzWAAAAAElFTkSuQmCC"
 
 
+# All static responses, formatted with the hub config and encoded once
+class Payloads:
+    def __init__(self, config) -> None:
+        self.broadcast = UPNP_BROADCAST.format(
+            config["IP"], config["HTTP_PORT"], config["SERIALNO"]
+        ).encode()
+        self.responses = {
+            st: UPNP_RESPOND_TEMPLATE.format(
+                config["IP"], config["HTTP_PORT"], st, config["SERIALNO"]
+            ).encode()
+            for st in ("urn:schemas-upnp-org:device:basic:1", "upnp:rootdevice")
+        }
+        self.description = DESCRIPTION_XML.format(
+            config["IP"],
+            config["HTTP_PORT"],
+            config["IP"],
+            config["SERIALNO"],
+            config["SERIALNO"],
+        ).encode()
+        self.icon_small = ICON_HEADERS.encode() + base64.b64decode(ICON_SMALL)
+        self.icon_big = ICON_HEADERS.encode() + base64.b64decode(ICON_BIG)
+
+        self.apiconfig = serialize.encode_static(APICONFIG_JSON % config["MACADDRESS"])
+        self.newdevelopersync = serialize.encode_static(NEWDEVELOPERSYNC_JSON)
+        # '"schedules":...}', appended to '{"lights":{...},'
+        self.api_tail = serialize.encode_static(
+            API_TAIL_JSON
+            % (
+                config["GATEWAYIP"],
+                config["MACADDRESS"],
+                config["IP"],
+                config["HTTP_PORT"],
+            )
+        )[1:]
+
+
 class Broadcaster:
-    def __init__(self, config, logger: logging.Logger) -> None:
+    def __init__(self, config, payloads, logger: logging.Logger) -> None:
         self.config = config
+        self.payloads = payloads
         self.logger = logger
         self.event_loop = asyncio.get_event_loop()
+        self.wakeup = asyncio.Event()
 
-    async def run(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-
-        self.sock.bind((self.config["IP"], 0))
-        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 20)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # sock: already bound socket, e.g. taken over from another process
+    async def run(self, sock=None):
+        if sock is not None:
+            self.sock = sock
+        else:
+            self.sock = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP
+            )
+            self.sock.bind((self.config["IP"], 0))
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 20)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.setblocking(False)
 
         self.logger.info("Starting broadcast loop")
@@ -156,10 +226,22 @@ class Broadcaster:
             self.logger.debug("Sending broadcast")
             await self.event_loop.sock_sendto(
                 self.sock,
-                UPNP_BROADCAST.encode(),
+                self.payloads.broadcast,
                 (self.config["BCAST_IP"], self.config["UPNP_PORT"]),
             )
-            await asyncio.sleep(self.config["BROADCAST_INTERVAL"])
+            # sleep until the next interval or until announce() is called
+            try:
+                await asyncio.wait_for(
+                    self.wakeup.wait(), self.config["BROADCAST_INTERVAL"]
+                )
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    # Re-announce right away, e.g. after the device list changed.
+    # Must be called from the event loop thread.
+    def announce(self):
+        self.wakeup.set()
 
     async def stop(self):
         self.logger.debug("Stopping broadcast loop")
@@ -167,28 +249,48 @@ class Broadcaster:
 
 
 class Responder:
-    def __init__(self, config, logger: logging.Logger) -> None:
+    def __init__(
+        self, config, payloads, logger: logging.Logger, capture=None
+    ) -> None:
         self.config = config
+        self.payloads = payloads
         self.logger = logger
+        self.capture = capture
+        self.capture_id = None
         self.event_loop = asyncio.get_event_loop()
 
-    async def run(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind(("", self.config["UPNP_PORT"]))
+    # sock, sockresp: already bound sockets, e.g. taken over from another process
+    async def run(self, sock=None, sockresp=None):
+        if sock is not None:
+            self.sock = sock
+        else:
+            self.sock = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP
+            )
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(("", self.config["UPNP_PORT"]))
+        # also for sockets from systemd, which are bound but did not join the
+        # group. A socket taken over from another hub is a member already.
         mreq = struct.pack(
             "4sl", socket.inet_aton(self.config["BCAST_IP"]), socket.INADDR_ANY
         )
-        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        try:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
         self.sock.setblocking(False)
 
         # Issue 9: create separate response socket bound to assigned interface
-        self.sockresp = socket.socket(
-            socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP
-        )
-        self.sockresp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sockresp.bind((self.config["IP"], self.config["UPNP_PORT"]))
-        self.sock.setblocking(False)
+        if sockresp is not None:
+            self.sockresp = sockresp
+        else:
+            self.sockresp = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP
+            )
+            self.sockresp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sockresp.bind((self.config["IP"], self.config["UPNP_PORT"]))
+        self.sockresp.setblocking(False)
 
         self.logger.info("Starting response loop")
         await self.loop()  # Start the loop response task
@@ -198,12 +300,14 @@ class Responder:
             try:
                 self.logger.debug("Waiting for M-SEARCH")
                 data, addr = await self.event_loop.sock_recvfrom(self.sock, 1024)
+                if self.capture is not None:
+                    self.capture_id = self.capture.datagram(data)
                 data = data.decode()  # type: ignore
             # if socket closed by stop() method
             except ConnectionResetError:
                 break
             except socket.error as e:
-                if e.winerror == 995:
+                if getattr(e, "winerror", None) == 995 or self.sock.fileno() == -1:
                     break
                 else:
                     self.logger.error(e)
@@ -217,48 +321,34 @@ class Responder:
                             "received urn:schemas-upnp-org:device:basic:1"
                         )
 
-                        resp = UPNP_RESPOND_TEMPLATE.format(
-                            self.config["IP"],
-                            self.config["HTTP_PORT"],
-                            "urn:schemas-upnp-org:device:basic:1",
-                            self.config["SERIALNO"],
-                        )
+                        resp = self.payloads.responses[
+                            "urn:schemas-upnp-org:device:basic:1"
+                        ]
 
-                        await self.event_loop.sock_sendto(
-                            self.sockresp, resp.encode(), addr
-                        )  # type: ignore
+                        await self.respond(resp, addr)
                         # self.logger.debug("Response sent: "+resp)
                     elif "upnp:rootdevice" in data:
                         self.logger.debug("received upnp:rootdevice")
-                        resp = UPNP_RESPOND_TEMPLATE.format(
-                            self.config["IP"],
-                            self.config["HTTP_PORT"],
-                            "upnp:rootdevice",
-                            self.config["SERIALNO"],
-                        )
-                        await self.event_loop.sock_sendto(
-                            self.sockresp, resp.encode(), addr
-                        )  # type: ignore
+                        resp = self.payloads.responses["upnp:rootdevice"]
+                        await self.respond(resp, addr)
                         # self.logger.debug("Response sent: "+resp)
                     elif "ssdp:all" in data:
                         self.logger.debug(
                             "received ssdp:all responding with upnp:rootdevice"
                         )
-                        resp = UPNP_RESPOND_TEMPLATE.format(
-                            self.config["IP"],
-                            self.config["HTTP_PORT"],
-                            "upnp:rootdevice",
-                            self.config["SERIALNO"],
-                        )
-                        await self.event_loop.sock_sendto(
-                            self.sockresp, resp.encode(), addr
-                        )  # type: ignore
+                        resp = self.payloads.responses["upnp:rootdevice"]
+                        await self.respond(resp, addr)
                         # self.logger.debug("Response sent: "+resp)
                     else:
                         self.logger.debug("ignoring")
                     self.logger.debug("----------------------")
                     self.logger.debug("  ")
 
+    async def respond(self, resp, addr):
+        if self.capture is not None:
+            self.capture.datagram_response(self.capture_id, resp)
+        await self.event_loop.sock_sendto(self.sockresp, resp, addr)
+
     async def stop(self):
         self.logger.debug("Stopping response loop")
         await asyncio.to_thread(self.sock.close)
@@ -266,23 +356,47 @@ class Responder:
 
 
 class Httpd:
-    def __init__(self, devices, config, logger: logging.Logger) -> None:
+    def __init__(
+        self,
+        devices,
+        state,
+        config,
+        payloads,
+        logger: logging.Logger,
+        refresher=None,
+        capture=None,
+        admission=None,
+    ) -> None:
         self.config = config
+        self.payloads = payloads
         self.logger = logger
         self.devices = devices
+        self.state = state
+        self.refresher = refresher
+        self.capture = capture
+        self.admission = admission
+        # listing bodies of the current state version, by request kind
+        self.bodies = {}
+        # connections that are being handled
+        self.tasks = set()
+        self.accepting = True
 
         self.event_loop = asyncio.get_event_loop()
 
-    async def run(self):
+    # sock: already listening socket, e.g. taken over from another process
+    async def run(self, sock=None):
         try:
             self.logger.info(
                 "Starting HTTP server on {IP}:{HTTP_PORT}".format(**self.config)
             )
 
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.sock.bind((self.config["IP"], self.config["HTTP_PORT"]))
-            self.sock.listen(100)
+            if sock is not None:
+                self.sock = sock
+            else:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.sock.bind((self.config["IP"], self.config["HTTP_PORT"]))
+                self.sock.listen(100)
             self.sock.setblocking(False)
 
             await self.loop()
@@ -291,21 +405,40 @@ class Httpd:
             self.logger.error("Http Socket Error: {}".format(msg))
 
     async def loop(self):
-        while True:
+        while self.accepting:
             try:
                 client, addr = await self.event_loop.sock_accept(self.sock)
             except ConnectionResetError:
                 break
             # if socket closed by stop() method [WinError 995] Der E/A-Vorgang wurde wegen eines Threadendes oder einer Anwendungsanforderung abgebrochen
             except socket.error as e:
-                if e.winerror == 995:
+                if getattr(e, "winerror", None) == 995 or self.sock.fileno() == -1:
                     break
                 else:
                     self.logger.error(e)
                     continue
             else:
                 self.logger.debug("Received connection from {}".format(addr))
-                self.event_loop.create_task(self.handle(client, addr))
+                task = self.event_loop.create_task(self.handle(client, addr))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    # Stop accepting without losing a connection that was accepted already.
+    # Cancelling a pending sock_accept could drop one, so the reader is
+    # removed first and an accept that just completed gets handled.
+    async def stop_accepting(self):
+        self.accepting = False
+        try:
+            self.event_loop.remove_reader(self.sock.fileno())
+        except NotImplementedError:
+            pass
+        await asyncio.sleep(0)
+
+    # Wait for the connections that are being handled
+    async def drain(self, timeout):
+        if self.tasks:
+            self.logger.debug("Draining {} connections".format(len(self.tasks)))
+            await asyncio.wait(list(self.tasks), timeout=timeout)
 
     async def handle(self, client: socket.socket, addr):
         try:
@@ -328,12 +461,33 @@ class Httpd:
                 self.logger.debug("Connection closed by {}".format(addr))
             else:
                 self.logger.debug("Received data from {}: {}".format(addr, data))
-                await self.handle_request(client, data)
+                if self.capture is not None:
+                    self.capture.request(client, data.encode())
+                try:
+                    await self.admit(client, addr, data)
+                finally:
+                    if self.capture is not None:
+                        self.capture.done(client)
                 client.close()
 
+    # Commands go first, see AdmissionControl
+    async def admit(self, client, addr, data):
+        if self.admission is None:
+            await self.handle_request(client, data)
+            return
+        cls = classify(data)
+        if not await self.admission.acquire(cls, addr[0]):
+            self.logger.debug("Shed {} request from {}".format(cls, addr))
+            await self.send(client, SERVICE_UNAVAILABLE)
+            return
+        try:
+            await self.handle_request(client, data)
+        finally:
+            self.admission.release(cls, addr[0])
+
     async def handle_request(self, client, data):
         if "test" in data:
-            await self.event_loop.sock_sendall(client, "ok".encode())
+            await self.send(client, "ok".encode())
             return
 
         searchObj = re.search(r"content-length: (\d+)", data, re.I)
@@ -353,34 +507,19 @@ class Httpd:
 
         if "description.xml" in data:
             # send description.xml and end for get request
-            await self.event_loop.sock_sendall(client, DESCRIPTION_XML.encode())
+            await self.send(client, self.payloads.description)
             self.logger.debug("{} Sent HTTP description.xml Response".format(client))
             # alexa discovery request
             self.logger.debug("Alexa, discover devices")
 
         elif "hue_logo_0.png" in data:
-            await self.event_loop.sock_sendall(client, ICON_HEADERS.encode())
-            await self.event_loop.sock_sendall(
-                client, ICON_SMALL.decode("base64").encode()
-            )
+            await self.send(client, self.payloads.icon_small)
         elif "hue_logo_3.png" in data:
-            await self.event_loop.sock_sendall(client, ICON_HEADERS.encode())
-            await self.event_loop.sock_sendall(
-                client, ICON_BIG.decode("base64").encode()
-            )
+            await self.send(client, self.payloads.icon_big)
 
         elif re.match(r"GET /api/.*lights ", data, re.I):
-            resp = "\n{"
-            i = 1
-            for device in self.devices.values():
-                # TODO: Force update of device? dst = device.st()
-                resp += f'"{device.id}":'
-                resp += await self.get_onelight_json(device)
-                if i < len(self.devices):
-                    resp += ","
-                i += 1
-            resp += "}\n"
-            await self.send_json(client, resp)
+            self.refresh(self.devices.values())
+            await self.send_versioned(client, data, "lights", self.build_lights)
 
         elif "PUT /api" in data:
             matchObj = re.match(r"PUT /api/(.*)lights/(.+)/state", data, re.I)
@@ -398,7 +537,7 @@ class Httpd:
                     "%s Content data=---\n%s\n---" % (client, data[-contentLength:])
                 )
 
-                parsedContent = json.loads(data[-contentLength:])
+                parsedContent = serialize.loads(data[-contentLength:])
 
                 self.logger.debug(
                     "%s Parsed Content data=---\n%s\n---" % (client, str(parsedContent))
@@ -410,38 +549,39 @@ class Httpd:
                 self.logger.debug(f"device number: {device_id}")
                 device = self.devices.get(device_id)
                 if not device:
-                    await self.send_json(client, "{}")
+                    await self.send_json(client, b"{}")
                     return
 
                 erg = await device.set(parsedContent)
 
-                await self.send_json(client, json.dumps(erg))
+                await self.send_json(client, serialize.dumps(erg))
 
             # All other PUT /api/ send back a blank response
             else:
-                await self.send_json(client, "")
+                await self.send_json(client, b"")
 
         # Requesting the state of just one light
         elif re.match(r"GET /api/.*lights/(.+) ", data, re.I):
             self.logger.debug("{} Got request for one light".format(client))
             matchObj = re.match(r"GET /api/.*lights/(.+) ", data, re.I)
             if not matchObj:
-                await self.send_json(client, "{}")
+                await self.send_json(client, b"{}")
                 return
             device_id = matchObj.group(1)
             if device_id not in self.devices:
-                await self.send_json(client, "{}")
+                await self.send_json(client, b"{}")
                 return
             device = self.devices[device_id]
-            # TODO: Force update of device? dst = device.st()
-            OneResp = await self.get_onelight_state_json(device)
-            await self.send_json(client, OneResp)
+            self.refresh((device,))
+            await self.send_versioned(
+                client, data, None, lambda: self.get_onelight_state_json(device)
+            )
 
         # Assuming this is a new device registration or config request
         elif "GET /api" in data:
             if "/config" in data:
                 self.logger.debug("{} Got request for /config".format(client))
-                await self.send_json(client, APICONFIG_JSON)
+                await self.send_json(client, self.payloads.apiconfig)
                 self.logger.debug("{} Sent API Config".format(client))
             else:
                 newDev = "newdeveloper"
@@ -451,117 +591,263 @@ class Httpd:
                 self.logger.debug(
                     "{} Got request for new dev: {}".format(client, newDev)
                 )
-                json_resp = """{"lights":{"""
-                i = 1
-                for device in self.devices.values():
-                    json_resp += f""""{device.id}":"""
-                    json_resp += await self.get_onelight_json(device)
-                    if i < len(self.devices):
-                        json_resp += ","
-                    i += 1
-
-                json_resp += (
-                    """},"schedules":{"1":{"time":"2012-10-29T12:00:00","description":"","name":"schedule","command":{"body":{"on":true,"xy":null,"bri":null,"transitiontime":null},"address":"/api/newdeveloper/groups/0/action","method":"PUT"}}},"config":{"portalservices":false,"gateway":"%s","mac":"%s","swversion":"01005215","linkbutton":false,"ipaddress":"%s:%s","proxyport":0,"swupdate":{"text":"","notify":false,"updatestate":0,"url":""},"netmask":"255.255.255.0","name":"Philips hue","dhcp":true,"proxyaddress":"","whitelist":{"newdeveloper":{"name":"test user","last use date":"2015-02-04T21:35:18","create date":"2012-10-29T12:00:00"}},"UTC":"2012-10-29T12:05:00"},"groups":{"1":{"name":"Group 1","action":{"on":true,"bri":254,"hue":33536,"sat":144,"xy":[0.346,0.3568],"ct":201,"alert":null,"effect":"none","colormode":"xy","reachable":null},"lights":["1","2"]}},"scenes":{}}\n"""
-                    % (
-                        self.config["GATEWAYIP"],
-                        self.config["MACADDRESS"],
-                        self.config["IP"],
-                        self.config["HTTP_PORT"],
-                    )
-                )
-                await self.send_json(client, json_resp)
+                self.refresh(self.devices.values())
+                await self.send_versioned(client, data, "api", self.build_api)
                 self.logger.debug("{} Sent HTTP New Dev Response".format(client))
 
         # I only saw a POST when registering the username
         elif "POST /api" in data:
-            await self.send_json(client, NEWDEVELOPERSYNC_JSON)
+            await self.send_json(client, self.payloads.newdevelopersync)
             self.logger.debug("{} Sent HTTP New Dev Sync Response".format(client))
         else:
-            await self.event_loop.sock_sendall(
+            await self.send(
                 client, "HTTP/1.1 404 Not Found".encode()
             )
 
         self.logger.debug("-------------------------------")
         self.logger.debug("    ")
 
-    async def get_onelight_json(self, device):
-        # example template values: "on", "[0.0,0.0]", "Hue Lamp 1", "254", "201"
-        # on, bri, xy, ct, name
-        data = await self.get_json_att(device, ALL)
-        data["uniqueid"] = self.gen_unique_id()
-        return json.dumps(data)
-
-    def gen_unique_id(self):
-        # gen "00:11:22:33:44:55:66:77-88" like id
-        serial = uuid.uuid4().hex[:18]
-        return (
-            ":".join([serial[i : i + 2] for i in range(0, len(serial) - 2, 2)])
-            + "-"
-            + str(serial[-2:])
+    # Stale devices are fetched in the background, the response is built from
+    # the cached state. Fetched changes bump the state version, so the next
+    # poll gets them.
+    def refresh(self, devices):
+        if self.refresher is not None:
+            self.refresher.refresh(devices)
+
+    async def build_lights(self):
+        return b"{" + await self.get_lights_json(self.devices.snapshot()) + b"}"
+
+    async def build_api(self):
+        lights = await self.get_lights_json(self.devices.snapshot())
+        return b'{"lights":{' + lights + b"}," + self.payloads.api_tail
+
+    # Conditional GET: answers 304 if the client already has the current
+    # state version, otherwise sends the body with ETag and Last-Modified.
+    # Bodies with a kind are kept until the next state change.
+    async def send_versioned(self, client, data, kind, build):
+        version = self.state.version
+        etag = '"{}-{}-{}"'.format(
+            self.config["SERIALNO"], self.state.epoch, version
         )
+        modified = email.utils.formatdate(self.state.modified, usegmt=True)
 
-    async def get_onelight_state_json(self, device):
-        # example template values: "on", "[0.0,0.0]", "Hue Lamp 1", "254", "201"
-        # on, bri, xy, ct, name
-        return json.dumps(await self.get_json_att(device, GETSTATE))
-
-    async def get_json_att(self, device, template):
-        json_resp = copy.deepcopy(template)
-
-        json_resp["state"]["on"] = device.on
-        json_resp["state"]["hue"] = device.hue
-        json_resp["state"]["sat"] = device.sat
-        json_resp["state"]["bri"] = device.bri
-        json_resp["state"]["ct"] = device.ct
-        json_resp["state"]["xy"] = device.xy
-        json_resp["state"]["colormode"] = device.colormode
-        json_resp["name"] = device.name
-        json_resp["swupdate"]["lastinstall"] = (
-            datetime.datetime.now().isoformat().split(".")[0]
-        )
+        if self.not_modified(data, etag, int(self.state.modified)):
+            date_str = email.utils.formatdate(timeval=None, usegmt=True)
+            await self.send(
+                client, (NOT_MODIFIED_HEADERS % (etag, modified, date_str)).encode()
+            )
+            return
+
+        cached = self.bodies.get(kind)
+        if cached is not None and cached[0] == version:
+            resp = cached[1]
+        else:
+            resp = await build()
+            if kind is not None:
+                self.bodies[kind] = (version, resp)
+
+        headers = "ETAG: {}\r\n".format(etag)
+        # A Last-Modified within the current second could also cover a change
+        # that is still to come in the same second, only send it once it is safe
+        if time.time() - self.state.modified >= 1:
+            headers += "LAST-MODIFIED: {}\r\n".format(modified)
+        await self.send_json(client, resp, headers)
+
+    @staticmethod
+    def not_modified(data, etag, modified):
+        if match := re.search(r"^if-none-match:[ \t]*(.*?)\s*$", data, re.I | re.M):
+            tags = [tag.strip() for tag in match.group(1).split(",")]
+            return "*" in tags or etag in tags or "W/" + etag in tags
+        if match := re.search(r"^if-modified-since:[ \t]*(.*?)\s*$", data, re.I | re.M):
+            try:
+                since = email.utils.parsedate_to_datetime(match.group(1))
+            except (TypeError, ValueError):
+                return False
+            return modified <= since.timestamp()
+        return False
+
+    # '"id":{...},"id":{...}' of all devices in the snapshot. Large listings
+    # yield to the loop every LISTING_CHUNK lights, so commands that arrive
+    # meanwhile are not stuck behind them.
+    async def get_lights_json(self, devices):
+        parts = []
+        for i, device in enumerate(devices.values(), 1):
+            parts.append(
+                b'"%s":%s' % (device.id.encode(), await self.get_onelight_json(device))
+            )
+            if i % self.config["LISTING_CHUNK"] == 0:
+                await asyncio.sleep(0)
+        return b",".join(parts)
+
+    # Templates of the device's light profile, see profiles.py
+    def profile(self, device):
+        return profiles.get(device.profile, self.config["COMPACT_LIGHTS"])
 
-        return json_resp
+    # Serialized lights are cached on the device until its state changes
+    async def get_onelight_json(self, device):
+        if (resp := device.cache.get("all")) is None:
+            resp = self.profile(device).all.render(device).encode()
+            device.cache["all"] = resp
+        return resp
+
+    # Fill the caches of all devices, e.g. before serving the first discovery.
+    # Returns the number of lights and the bytes of their light JSON.
+    def prerender(self):
+        devices = self.devices.snapshot()
+        size = 0
+        for device in devices.values():
+            profile = self.profile(device)
+            device.cache["all"] = profile.all.render(device).encode()
+            device.cache["state"] = profile.getstate.render(device).encode()
+            size += len(device.cache["all"])
+        return len(devices), size
 
-    async def send_json(self, client, resp):
+    async def get_onelight_state_json(self, device):
+        if (resp := device.cache.get("state")) is None:
+            resp = self.profile(device).getstate.render(device).encode()
+            device.cache["state"] = resp
+        return resp
+
+    async def send_json(self, client, resp: bytes, extra_headers=""):
         date_str = email.utils.formatdate(timeval=None, localtime=False, usegmt=True)
-        full_resp = (JSON_HEADERS % (len(resp), date_str, resp)).replace("\n", "\r\n")
-        await self.event_loop.sock_sendall(client, full_resp.encode())
+        headers = JSON_HEADERS % (len(resp), date_str, extra_headers)
+        await self.send(client, headers.encode() + resp)
+
+    async def send(self, client, data):
+        if self.capture is not None:
+            self.capture.response(client, data)
+        await self.event_loop.sock_sendall(client, data)
 
     async def stop(self):
         self.logger.debug("Stopping HTTP Server")
         await asyncio.to_thread(self.sock.close)
 
 
+# The slots of LightState, a device is its own LightState
+STATE_SLOTS = {name: LightState.__dict__[name] for name in LightState.__slots__}
+
+
+# Device attribute backed by its LightState slot. Setting it (e.g.
+# device.on = False from the host app) clears the cached JSON and bumps the
+# hub state version, so the next poll sees the change. The hub itself
+# writes the slots with write_state() and publishes the changes once.
+def state_attr(name):
+    slot = STATE_SLOTS[name]
+
+    def set(self, value):
+        slot.__set__(self, value)
+        self.touched()
+
+    return property(slot.__get__, set)
+
+
 #
 # This is the main object which all other handlers inherit from:
 
 
-class hue_upnp_super_handler(object):
+class hue_upnp_super_handler(LightState):
+    # Devices are their LightState plus a few slots, so thousands of them
+    # are cheap. The __dict__ is only created for attributes that are not
+    # listed here (e.g. of subclasses, or a per device gamut).
+    __slots__ = (
+        "name",
+        "id",
+        "logger",
+        "hub",
+        "lastinstall",
+        "commands",
+        "_cache",
+        "_colors",
+        "__dict__",
+    )
+    # State attributes that can be changed with update_state()
+    STATE_ATTRS = LightState.__slots__
+    # the gamut of the lamp, all of them have the same by default
+    gamut = GAMUT
+
+    on = state_attr("on")
+    bri = state_attr("bri")
+    hue = state_attr("hue")
+    sat = state_attr("sat")
+    ct = state_attr("ct")
+    colormode = state_attr("colormode")
+    reachable = state_attr("reachable")
+
+    @property
+    def xy(self):
+        return STATE_SLOTS["xy"].__get__(self)
+
+    @xy.setter
+    def xy(self, value):
+        STATE_SLOTS["xy"].__set__(self, None if value is None else tuple(value))
+        self.touched()
+
+    # For LightTemplate and the other users of a LightState
+    @property
+    def state(self):
+        return self
+
     def __init__(self, name, id, logger, on=False, bri=1):
         self.name = name
         self.id = id
         self.logger = logger
-
-        self.on = on
-        self.bri = bri
-
+        self.hub = None
+        self.lastinstall = None
+        # number of commands received, see StateRefresher.run
+        self.commands = 0
+        self._cache = None
+        self._colors = None
+
+        self.write_state({"on": on, "bri": bri, "reachable": True})
         self.get_default()
 
+    # serialized responses, cleared on every state change. Created on first
+    # use, like the color cache.
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = {}
+        return self._cache
+
+    # recent color conversions of this device, created on first use
+    @property
+    def colors(self):
+        if self._colors is None:
+            self._colors = ColorCache()
+        return self._colors
+
     # Set default initial values
     # Can be overridden, or used as a super, or just use the defaults.
     def get_default(self):
-        self.xy = [0.0, 0.0]
-        self.ct = 199
-        self.hue = 0
-        self.sat = 254
-        self.colormode = "ct"
+        self.write_state(
+            {"xy": (0.0, 0.0), "ct": 199, "hue": 0, "sat": 254, "colormode": "ct"}
+        )
 
     # Super set method, parses incomming data and runs the appropriate method.
     async def set(self, data):
         results = []
+        changes = {}
+        # fetches that started before this command are outdated
+        self.commands += 1
+
+        # transitiontime is in 1/10 s, bri, ct and xy are then faded by the hub
+        transition = data.get("transitiontime")
+        fader = self.hub.fader if self.hub is not None else None
+        fade = {}
+        if fader is not None:
+            fader.cancel(self.id)
 
         for elm in data:
             match elm:
+                case "transitiontime":
+                    self.logger.debug("transitiontime received: {}".format(transition))
+                    ret = type(transition) is int and transition >= 0
+
+                case "bri" | "ct" | "xy" if transition and fader is not None:
+                    self.logger.debug("{} fade received: {}".format(elm, data[elm]))
+                    fade[elm] = data[elm]
+                    ret = True
+
                 case "on":
                     self.logger.debug("on received: {}".format(data["on"]))
                     if data["on"]:
@@ -574,32 +860,30 @@ class hue_upnp_super_handler(object):
 
                 case "ct":
                     self.logger.debug("ct received: {}".format(data["ct"]))
-                    if ret := await self.set_ct(data["ct"]):
-                        self.colormode = "ct"
+                    ret = await self.set_ct(data["ct"])
 
                 case "xy":
                     self.logger.debug("xy received: {}".format(data["xy"]))
 
-                    if ret := await self.set_xy(data["xy"]):
-                        self.colormode = "hs"
+                    ret = await self.set_xy(data["xy"])
 
                 case "hue":
                     self.logger.debug("hue received: {}".format(data["hue"]))
 
-                    if ret := await self.set_hue(data["hue"]):
-                        self.colormode = "hs"
+                    ret = await self.set_hue(data["hue"])
 
                 case "sat":
                     self.logger.debug("sat received: {}".format(data["sat"]))
 
-                    if ret := await self.set_sat(data["sat"]):
-                        self.colormode = "hs"
+                    ret = await self.set_sat(data["sat"])
 
                 case _:  # default
                     self.logger.error("ERROR: Unknown command: {}".format(elm))
                     ret = False
 
             if ret:
+                if elm in self.STATE_ATTRS and elm not in fade:
+                    changes[elm] = getattr(self, elm)
                 results.append(
                     {"success": {f"/lights/{self.id}/state/{elm}": data[elm]}}
                 )
@@ -614,8 +898,96 @@ class hue_upnp_super_handler(object):
                     }
                 )
 
+        if changes:
+            changes.update(self.sync_color(changes))
+            self.changed(changes, "command")
+
+        if fade and type(transition) is int and transition > 0:
+            fader.start(self, fade, transition / 10)
+        elif fade:
+            await self.apply_frame(fade)
+
         return results
 
+    # Apply one step of a fade (or its final values) through the set_* methods
+    async def apply_frame(self, values):
+        changes = {}
+        for key, value in values.items():
+            if await getattr(self, f"set_{key}")(value):
+                changes[key] = getattr(self, key)
+        if changes:
+            changes.update(self.sync_color(changes))
+            self.changed(changes, "fade")
+        return changes
+
+    # Set the colormode from the changed attributes (xy wins over ct wins
+    # over hue/sat, like on a real bridge) and derive the other color
+    # representations from it. Returns the derived attributes.
+    def sync_color(self, changes):
+        if "xy" in changes:
+            mode, value = "xy", self.xy
+        elif "ct" in changes:
+            mode, value = "ct", self.ct
+        elif "hue" in changes or "sat" in changes:
+            mode, value = "hs", (self.hue, self.sat)
+        else:
+            return {}
+
+        derived = {"colormode": mode}
+        if mode != "xy":
+            derived["xy"] = self.colors.convert(value, mode, "xy", self.gamut)
+        if mode != "ct":
+            derived["ct"] = self.colors.convert(value, mode, "ct", self.gamut)
+        if mode != "hs":
+            derived["hue"], derived["sat"] = self.colors.convert(
+                value, mode, "hs", self.gamut
+            )
+        self.write_state(derived)
+        return derived
+
+    # Current color as (r, g, b) 0-255, for backends that only understand RGB
+    @property
+    def rgb(self):
+        match self.colormode:
+            case "xy":
+                return self.colors.convert(self.xy, "xy", "rgb", self.gamut)
+            case "ct":
+                return self.colors.convert(self.ct, "ct", "rgb", self.gamut)
+        return self.colors.convert((self.hue, self.sat), "hs", "rgb", self.gamut)
+
+    # Push state that changed outside of the hub (e.g. a physical switch).
+    # Does not call the on_* overrides.
+    def update_state(self, source="external", **changes):
+        for key in changes:
+            if key not in self.STATE_ATTRS:
+                raise AttributeError(f"Unknown state attribute: {key}")
+        self.write_state(changes)
+        self.changed(changes, source)
+
+    # Set state attributes without invalidating each of them, changed()
+    # publishes them afterwards
+    def write_state(self, changes):
+        for key, value in changes.items():
+            if key == "xy" and value is not None:
+                value = tuple(value)
+            STATE_SLOTS[key].__set__(self, value)
+
+    def changed(self, changes, source):
+        self.invalidate()
+        if self.hub is not None:
+            self.hub.state.bump()
+            self.hub.events.publish(StateChange(self.id, changes, source))
+
+    # A state attribute was set directly
+    def touched(self):
+        self.invalidate()
+        if self.hub is not None:
+            self.hub.state.bump()
+
+    def invalidate(self):
+        if self._cache:
+            self._cache.clear()
+
     # Default, should always be overridden
     async def set_on(self):
         self.logger.error(
@@ -656,6 +1028,14 @@ class hue_upnp_super_handler(object):
 
 
 class Device(hue_upnp_super_handler):
+    # Optional, (async) method returning the current state of the backend as a
+    # dict of state attributes (e.g. {"on": True, "bri": 120}). Raising or
+    # timing out marks the device as unreachable. See StateRefresher.
+    on_fetch = None
+    # What the light reports itself as: "plug", "dimmable" or "extended"
+    # (color), see profiles.py
+    profile = "extended"
+
     def __init__(self, name: str, on=False, bri=1, id=None) -> None:
         self.id = id
         self.name = name
@@ -663,67 +1043,102 @@ class Device(hue_upnp_super_handler):
             self.name, id, None, on, bri if bri <= 254 and bri >= 1 else 1
         )
 
-    def init(self, logger):
+    # Called by the hub when the device is added, the id (if not given)
+    # is assigned by the hub's DeviceRegistry.
+    def init(self, logger, hub=None):
         self.logger = logger
-        if not self.id:
-            self.id = str(int.from_bytes(hashlib.md5(self.name.encode()).digest()))[:10]
+        self.hub = hub
+        # devices added in the same second share the string
+        self.lastinstall = sys.intern(
+            datetime.datetime.now().isoformat().split(".")[0]
+        )
+
+    # Stable as long as the hub serial and the device id are, so the Echos
+    # recognize the light again after a restart with the same identity
+    @property
+    def uniqueid(self):
+        # gen "00:11:22:33:44:55:66:77-88" like id
+        serial = self.hub.config["SERIALNO"] if self.hub is not None else ""
+        serial = hashlib.md5(f"{serial}:{self.id}".encode()).hexdigest()[:18]
+        return (
+            ":".join([serial[i : i + 2] for i in range(0, len(serial) - 2, 2)])
+            + "-"
+            + str(serial[-2:])
+        )
 
     async def set_on(self):
         self.logger.debug(f"Device: {self.name} set ON!")
 
-        if await self.on_on() != False:
-            self.on = True
+        if await self.callback(self.on_on) != False:
+            self.write_state({"on": True})
             return True
         return False
 
     async def set_off(self):
         self.logger.debug(f"Device: {self.name} set OFF!")
 
-        if await self.on_off() != False:
-            self.on = False
+        if await self.callback(self.on_off) != False:
+            self.write_state({"on": False})
             return True
         return False
 
     async def set_bri(self, value):
         self.logger.debug(f"Device: {self.name} set BRI {self.bri}!")
 
-        if await self.on_bri(value) != False:
-            self.bri = value
+        if await self.callback(self.on_bri, value) != False:
+            self.write_state({"bri": value})
             return True
         return False
 
     async def set_ct(self, value):
         self.logger.debug(f"Device: {self.name} set CT {self.ct}!")
 
-        if await self.on_ct(value) != False:
-            self.ct = value
+        if await self.callback(self.on_ct, value) != False:
+            self.write_state({"ct": value})
             return True
         return False
 
     async def set_xy(self, value):
         self.logger.debug(f"Device: {self.name} set XY {self.xy}!")
 
-        if await self.on_xy(value) != False:
-            self.xy = value
+        value = clip_xy(value, self.gamut)
+        if await self.callback(self.on_xy, value) != False:
+            self.write_state({"xy": value})
             return True
         return False
 
     async def set_hue(self, value):
         self.logger.debug(f"Device: {self.name} set HUE {self.hue}!")
 
-        if await self.on_hue(value) != False:
-            self.hue = value
+        if await self.callback(self.on_hue, value) != False:
+            self.write_state({"hue": value})
             return True
         return False
 
     async def set_sat(self, value):
         self.logger.debug(f"Device: {self.name} set SAT {self.sat}!")
 
-        if await self.on_sat(value) != False:
-            self.sat = value
+        if await self.callback(self.on_sat, value) != False:
+            self.write_state({"sat": value})
             return True
         return False
 
+    # The on_* overrides may also be plain functions, they run in the hub's
+    # executor then so they may block. Anything awaitable they return (e.g.
+    # a lambda calling a coroutine function) is awaited on the loop.
+    async def callback(self, fn, *args):
+        if inspect.iscoroutinefunction(fn) or inspect.iscoroutinefunction(
+            getattr(fn, "__call__", None)
+        ):
+            return await fn(*args)
+        if self.hub is None:
+            result = fn(*args)
+        else:
+            result = await self.hub.run_sync(fn, *args)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
     async def on_on(self):
         return True
 
@@ -748,18 +1163,80 @@ class Device(hue_upnp_super_handler):
 
 class Hub(AbstractAsyncContextManager):
     def __init__(self, debug=False) -> None:
-        self.devices = {}
         self.config = {}
+        self.event_loop = None
+        self.broadcaster = None
 
         self.setup_debug(debug)
         self.gen_config()
 
+        self.devices = DeviceRegistry(self.logger)
+        self.devices.subscribe(self.on_devices_changed)
+        self.events = EventBus()
+        self.fader = FadeScheduler(self.config, self.logger)
+        self.refresher = StateRefresher(self.config, self.logger)
+        # shared backend connections for the on_* overrides
+        self.pool = ConnectionPool(self.config, self.logger)
+        self.state = StateVersion()
+        self.capture = None
+        self.admission = AdmissionControl(self.config, self.logger)
+        self.bridges = []
+        self.bridge_tasks = []
+        # set once run() serves
+        self.serving = asyncio.Event()
+        self.executor = None
+        self.executor_slots = None
+
     def gen_config(self):
+        self.config["IP"] = None  # detected by run() if not set
         self.config["GATEWAYIP"] = "1.1.1.1"
         self.config["HTTP_PORT"] = 80  # only port 80 is supported
         self.config["BCAST_IP"] = "239.255.255.250"
         self.config["UPNP_PORT"] = 1900  # type: ignore
         self.config["BROADCAST_INTERVAL"] = 200  # type: ignore
+        self.config["FADE_MAX_RATE"] = 10  # updates per second and device
+        # unix socket for zero downtime restarts, see Hub.run(takeover=True)
+        self.config["HANDOFF_PATH"] = None
+        self.config["HANDOFF_TIMEOUT"] = 10
+        self.config["DRAIN_TIMEOUT"] = 10
+        # Device.on_fetch: seconds a fetched state is fresh, parallel fetches
+        # and seconds until a fetch counts as failed
+        self.config["FETCH_TTL"] = 5
+        self.config["FETCH_CONCURRENCY"] = 8
+        self.config["FETCH_TIMEOUT"] = 2
+        # hub.pool: connections per backend, seconds until idle ones are
+        # closed, connect and request timeouts, retries and first backoff
+        self.config["POOL_SIZE"] = 4
+        self.config["POOL_IDLE_TIMEOUT"] = 30
+        self.config["POOL_CONNECT_TIMEOUT"] = 3
+        self.config["POOL_TIMEOUT"] = 5
+        self.config["POOL_RETRIES"] = 2
+        self.config["POOL_BACKOFF"] = 0.1
+        # file to record the Echo traffic to, see echohue.replay
+        self.config["CAPTURE"] = None
+        # requests handled at the same time, in total and per class, the
+        # waiting ones per class and how long they may wait, see
+        # AdmissionControl
+        self.config["ADMISSION_TOTAL"] = 32
+        self.config["ADMISSION_LIMITS"] = {
+            "command": 16,
+            "poll": 8,
+            "other": 4,
+            "discovery": 4,
+        }
+        self.config["ADMISSION_QUEUE"] = 64
+        self.config["ADMISSION_TIMEOUT"] = 5
+        self.config["DISCOVERY_PER_CLIENT"] = 2
+        self.config["LISTING_CHUNK"] = 50
+        # only the light keys the Echos need (profiles.COMPACT_KEYS), makes
+        # the discovery listing about half as large
+        self.config["COMPACT_LIGHTS"] = False
+        # seconds between polls of upstream Hue bridges, see Hub.mirror
+        self.config["PROXY_INTERVAL"] = 2
+        # threads for plain function on_* overrides and how many calls may
+        # wait for one, further calls wait on the loop
+        self.config["EXECUTOR_WORKERS"] = 4
+        self.config["EXECUTOR_QUEUE"] = 64
 
         self.gen_uuids()
 
@@ -836,49 +1313,212 @@ class Hub(AbstractAsyncContextManager):
         self.logger.addHandler(consoleHandlerError)
         self.logger.addHandler(consoleHandler)
 
-    def add(self, *devices: list[Device]):
+    # add, remove and rename may be called while the hub is running,
+    # also from other threads. Every call is applied atomically.
+    def add(self, *devices: Device):
         for device in devices:
             self.logger.debug("Adding device: " + device.name)
-            device.init(self.logger)
-            self.devices[device.id] = device
+            profiles.get(device.profile)
+            device.init(self.logger, self)
+        return self.devices.add(*devices)
+
+    def remove(self, *devices: Device | str):
+        return self.devices.remove(*devices)
+
+    def rename(self, device: Device | str, name: str):
+        return self.devices.rename(getattr(device, "id", device), name)
+
+    # Async iterator of StateChange events, optionally only for some devices.
+    # Use subscription.batch() to consume all pending changes at once.
+    def subscribe(self, device_ids=None, maxsize=1000):
+        return self.events.subscribe(device_ids, maxsize)
+
+    # Run a blocking function in the executor of the hub
+    async def run_sync(self, fn, *args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                self.config["EXECUTOR_WORKERS"], thread_name_prefix="echohue"
+            )
+        if self.executor_slots is None:
+            self.executor_slots = asyncio.Semaphore(
+                self.config["EXECUTOR_WORKERS"] + self.config["EXECUTOR_QUEUE"]
+            )
+        async with self.executor_slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, fn, *args
+            )
 
-    async def run(self):
-        global UPNP_BROADCAST, DESCRIPTION_XML, APICONFIG_JSON
+    # Serve the lights of a real Hue bridge next to the own devices, see
+    # UpstreamBridge. username is a user registered on that bridge.
+    def mirror(self, url, username):
+        from .proxy import UpstreamBridge
+
+        bridge = UpstreamBridge(self, url, username)
+        self.bridges.append(bridge)
+        if self.event_loop is not None and not self.event_loop.is_closed():
+            self.event_loop.call_soon_threadsafe(self.start_bridge, bridge)
+        return bridge
+
+    def start_bridge(self, bridge):
+        self.bridge_tasks.append(self.event_loop.create_task(bridge.run()))
+
+    # Shortcut for Device.update_state by device id
+    def update_state(self, device_id, source="external", **changes):
+        self.devices[device_id].update_state(source, **changes)
+
+    # Fetch the state of a device now (or join the running fetch), returns
+    # the changes. Must be called on the hub loop.
+    async def fetch(self, device_id):
+        return await self.refresher.fetch(self.devices[device_id])
+
+    def on_devices_changed(self, version, added, removed, renamed):
+        self.state.bump()
+        for device in removed:
+            if self.event_loop and not self.event_loop.is_closed():
+                self.event_loop.call_soon_threadsafe(self.refresher.forget, device.id)
+            else:
+                self.refresher.forget(device.id)
+        for device_id in renamed:
+            if device_id in self.devices:
+                self.devices[device_id].invalidate()
+        # Let the Echos know right away instead of waiting for the next interval
+        if self.broadcaster and self.event_loop and not self.event_loop.is_closed():
+            self.event_loop.call_soon_threadsafe(self.broadcaster.announce)
+
+    # takeover: start with the sockets of the hub serving at HANDOFF_PATH,
+    # which then drains and exits. Without it sockets passed by systemd
+    # socket activation are used, or new ones are created.
+    async def run(self, takeover=False):
         # same as the MACADDRESS with colons removed
         # Put our info in the responses
         if self.config.get("IP") is None:
             self.config["IP"] = self.get_ip()
-
-        UPNP_BROADCAST = UPNP_BROADCAST.format(
-            self.config["IP"], self.config["HTTP_PORT"], self.config["SERIALNO"]
+        # a hub can be run again after stop(), possibly on another loop
+        self.serving.clear()
+        self.executor_slots = None
+
+        handoff = None
+        if takeover:
+            handoff = HandoffClient(
+                self.config["HANDOFF_PATH"], self.config["HANDOFF_TIMEOUT"]
+            )
+            sockets, identity = await handoff.connect()
+            # same serial and mac, the Echos must not notice the restart
+            self.config.update(identity)
+            for device in self.devices.values():
+                device.invalidate()
+            self.logger.info("Took over sockets: {}".format(", ".join(sockets)))
+        else:
+            sockets = inherited_sockets()
+
+        self.payloads = Payloads(self.config)
+        self.logger.debug("JSON backend: {}".format(serialize.BACKEND))
+
+        self.event_loop = asyncio.get_running_loop()
+        self.events.event_loop = self.event_loop
+        if self.config["CAPTURE"]:
+            self.capture = CaptureWriter(self.config["CAPTURE"], self.config)
+            self.logger.info("Capturing traffic to {}".format(self.config["CAPTURE"]))
+        self.responder = Responder(
+            self.config, self.payloads, self.logger, self.capture
         )
-        DESCRIPTION_XML = DESCRIPTION_XML.format(
-            self.config["IP"],
-            self.config["HTTP_PORT"],
-            self.config["IP"],
-            self.config["SERIALNO"],
-            self.config["SERIALNO"],
+        self.broadcaster = Broadcaster(self.config, self.payloads, self.logger)
+        self.httpd = Httpd(
+            self.devices,
+            self.state,
+            self.config,
+            self.payloads,
+            self.logger,
+            self.refresher,
+            self.capture,
+            self.admission,
         )
-        APICONFIG_JSON = APICONFIG_JSON % (self.config["MACADDRESS"])
-
-        self.responder = Responder(self.config, self.logger)
-        self.broadcaster = Broadcaster(self.config, self.logger)
-        self.httpd = Httpd(self.devices, self.config, self.logger)
+        # after a takeover, the identity of the old hub is in the responses
+        start = time.perf_counter()
+        count, size = self.httpd.prerender()
+        self.logger.debug(
+            "Pre-rendered {} lights in {:.1f}ms".format(
+                count, (time.perf_counter() - start) * 1000
+            )
+        )
+        if count:
+            self.logger.info(
+                "Light listing: {} bytes, {:.0f} bytes per light".format(
+                    size, size / count
+                )
+            )
 
         async with asyncio.TaskGroup() as tg:
-            tg.create_task(self.responder.run())
-            tg.create_task(self.broadcaster.run())
-            tg.create_task(self.httpd.run())
+            self.tasks = [
+                tg.create_task(
+                    self.responder.run(
+                        sockets.get("ssdp"), sockets.get("ssdp_response")
+                    )
+                ),
+                tg.create_task(self.broadcaster.run(sockets.get("broadcast"))),
+                tg.create_task(self.httpd.run(sockets.get("http"))),
+            ]
+            self.bridge_tasks = [
+                tg.create_task(bridge.run()) for bridge in self.bridges
+            ]
+            # let the servers pick up the sockets
+            await asyncio.sleep(0)
+            if handoff is not None:
+                # before the old hub lets go
+                await handoff.ready()
+            self.serving.set()
+            if self.config["HANDOFF_PATH"]:
+                tg.create_task(HandoffServer(self.config["HANDOFF_PATH"], self).run())
+
+    # Bound sockets of the running hub, by handoff name
+    def sockets(self):
+        return {
+            "http": self.httpd.sock,
+            "ssdp": self.responder.sock,
+            "ssdp_response": self.responder.sockresp,
+            "broadcast": self.broadcaster.sock,
+        }
+
+    # Stop serving after the sockets were handed over: stop accepting, let
+    # the running requests finish and close our copies of the sockets.
+    async def release(self):
+        self.logger.info("Sockets handed over, draining...")
+        await self.httpd.stop_accepting()
+        for task in self.tasks + self.bridge_tasks:
+            task.cancel()
+        await self.httpd.drain(self.config["DRAIN_TIMEOUT"])
+        await self.fader.stop()
+        await self.refresher.stop()
+        await self.pool.close()
+        for sock in self.sockets().values():
+            sock.close()
+        if self.capture is not None:
+            self.capture.close()
+        self.logger.info("Hub released.")
 
     async def stop(self):
         self.logger.debug("Stopping hub...")
+        for task in self.bridge_tasks:
+            # may be called from another thread than the one running the hub
+            task.get_loop().call_soon_threadsafe(task.cancel)
         try:
             async with asyncio.TaskGroup() as tg:
+                tg.create_task(self.fader.stop())
+                tg.create_task(self.refresher.stop())
+                tg.create_task(self.pool.close())
                 tg.create_task(self.responder.stop())
                 tg.create_task(self.broadcaster.stop())
                 tg.create_task(self.httpd.stop())
         except Exception as e:
             self.logger.exception("Failed to stop hub: {}".format(e))
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+        self.executor_slots = None
+        if self.capture is not None:
+            self.capture.close()
+        # the next run() may be on another loop, which the old event is not
+        self.serving = asyncio.Event()
         self.logger.debug("Hub stopped.")
 
     async def __aenter__(self):
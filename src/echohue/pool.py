@@ -0,0 +1,229 @@
+import asyncio
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+from . import serialize
+
+# Methods that may be sent again if a request failed
+IDEMPOTENT = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+
+class HTTPResponse(namedtuple("HTTPResponse", ["status", "headers", "body"])):
+    # headers: dict with lower case names
+    def json(self):
+        return serialize.loads(self.body) if self.body else None
+
+
+class Connection:
+    __slots__ = ("reader", "writer", "used", "requests")
+
+    def __init__(self, reader, writer) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.used = time.monotonic()
+        # requests sent on this connection, > 0 once it was reused
+        self.requests = 0
+
+    @property
+    def closed(self):
+        return self.writer.is_closing() or self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+# Keep-alive TCP connections to one backend. At most POOL_SIZE connections
+# are open at a time, idle ones are closed after POOL_IDLE_TIMEOUT seconds.
+#
+#   async with pool.connection() as conn:
+#       conn.writer.write(b"on\n")
+#       await conn.reader.readline()
+#
+# A connection is only put back if the block did not raise.
+class TCPPool:
+    def __init__(self, host, port, config, logger) -> None:
+        self.host = host
+        self.port = port
+        self.config = config
+        self.logger = logger
+        self.idle = []
+        self.semaphore = asyncio.Semaphore(config["POOL_SIZE"])
+        self.closed = False
+
+    @asynccontextmanager
+    async def connection(self):
+        if self.closed:
+            raise ConnectionError(f"Pool for {self.host}:{self.port} is closed")
+        async with self.semaphore:
+            conn = self.get_idle() or await self.connect()
+            try:
+                yield conn
+            except BaseException:
+                conn.close()
+                raise
+            conn.requests += 1
+            conn.used = time.monotonic()
+            if self.closed or conn.closed:
+                conn.close()
+            else:
+                self.idle.append(conn)
+
+    # Most recently used connection that is still open
+    def get_idle(self):
+        expired = time.monotonic() - self.config["POOL_IDLE_TIMEOUT"]
+        while self.idle:
+            conn = self.idle.pop()
+            if conn.used >= expired and not conn.closed:
+                return conn
+            conn.close()
+        return None
+
+    async def connect(self):
+        self.logger.debug("Connecting to {}:{}".format(self.host, self.port))
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port),
+            self.config["POOL_CONNECT_TIMEOUT"],
+        )
+        return Connection(reader, writer)
+
+    async def close(self):
+        self.closed = True
+        idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+        for conn in idle:
+            try:
+                await conn.writer.wait_closed()
+            except OSError:
+                pass
+
+
+# Shared connections to the backends of the devices, available as hub.pool.
+# Requests that fail with a connection error or time out are retried
+# POOL_RETRIES times with exponential backoff starting at POOL_BACKOFF
+# seconds, non idempotent ones only if a reused connection was closed
+# before anything was sent back.
+#
+#   resp = await self.hub.pool.put("http://10.0.0.5/light", json={"on": True})
+class ConnectionPool:
+    def __init__(self, config, logger) -> None:
+        self.config = config
+        self.logger = logger
+        self.pools = {}
+
+    def tcp(self, host, port):
+        pool = self.pools.get((host, port))
+        if pool is None or pool.closed:
+            pool = self.pools[(host, port)] = TCPPool(
+                host, port, self.config, self.logger
+            )
+        return pool
+
+    async def request(
+        self, method, url, body=b"", json=None, headers=None, timeout=None
+    ):
+        method = method.upper()
+        parts = urlsplit(url)
+        if parts.scheme != "http":
+            raise ValueError(f"Only http:// urls are supported: {url}")
+        pool = self.tcp(parts.hostname, parts.port or 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        if json is not None:
+            body = serialize.dumps(json)
+            headers = {"Content-Type": "application/json", **(headers or {})}
+        elif isinstance(body, str):
+            body = body.encode()
+        head = [f"{method} {path} HTTP/1.1", f"Host: {parts.netloc}"]
+        head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        if body or method in ("POST", "PUT"):
+            head.append(f"Content-Length: {len(body)}")
+        data = ("\r\n".join(head) + "\r\n\r\n").encode() + body
+
+        timeout = timeout or self.config["POOL_TIMEOUT"]
+        retries = self.config["POOL_RETRIES"]
+        for attempt in range(retries + 1):
+            stale = False
+            try:
+                async with pool.connection() as conn:
+                    stale = conn.requests > 0
+                    resp = await asyncio.wait_for(
+                        self.exchange(conn, method, data), timeout
+                    )
+                    if resp.headers.get("connection", "").lower() == "close":
+                        conn.close()
+                    return resp
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                # a reused connection that the backend closed meanwhile
+                stale = stale and isinstance(
+                    e, (ConnectionResetError, BrokenPipeError)
+                )
+                if attempt == retries or not (method in IDEMPOTENT or stale):
+                    raise
+                self.logger.debug(
+                    "{} {} failed ({!r}), retrying".format(method, url, e)
+                )
+                if not stale:
+                    await asyncio.sleep(self.config["POOL_BACKOFF"] * 2**attempt)
+
+    async def exchange(self, conn, method, data):
+        conn.writer.write(data)
+        await conn.writer.drain()
+
+        try:
+            head = await conn.reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            raise ConnectionResetError("Connection closed by the backend")
+        lines = head.decode("latin-1").split("\r\n")
+        version, status = lines[0].split(" ", 2)[:2]
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        if method == "HEAD" or status.startswith("1") or status in ("204", "304"):
+            body = b""
+        elif "chunked" in headers.get("transfer-encoding", "").lower():
+            body = await self.read_chunked(conn.reader)
+        elif "content-length" in headers:
+            body = await conn.reader.readexactly(int(headers["content-length"]))
+        else:
+            # no length, the body ends with the connection
+            body = await conn.reader.read()
+            headers["connection"] = "close"
+        if version == "HTTP/1.0" and "keep-alive" not in headers.get("connection", ""):
+            headers["connection"] = "close"
+        return HTTPResponse(int(status), headers, body)
+
+    @staticmethod
+    async def read_chunked(reader):
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if size == 0:
+                # trailers until the empty line
+                while await reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def put(self, url, body=b"", **kwargs):
+        return await self.request("PUT", url, body, **kwargs)
+
+    async def post(self, url, body=b"", **kwargs):
+        return await self.request("POST", url, body, **kwargs)
+
+    async def close(self):
+        pools, self.pools = list(self.pools.values()), {}
+        await asyncio.gather(*(pool.close() for pool in pools))
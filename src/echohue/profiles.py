@@ -0,0 +1,128 @@
+import copy
+
+from .defaults import ALL, GETSTATE
+from .state import LightTemplate, StateFormat
+
+# Keys of a light that the Echos need, the compact profiles only have these
+COMPACT_KEYS = (
+    "state",
+    "type",
+    "name",
+    "modelid",
+    "manufacturername",
+    "uniqueid",
+    "swversion",
+)
+
+
+# What a light reports itself as (Device.profile). The static parts of the
+# light JSON are encoded once per profile and shared by all its lights.
+class Profile:
+    def __init__(self, name, light, state_keys=None) -> None:
+        self.name = name
+        self.light = light
+        state = StateFormat(state_keys) if state_keys is not None else None
+        self.all = LightTemplate(light, state)
+        self.getstate = LightTemplate(
+            {key: light[key] for key in GETSTATE if key in light}, state
+        )
+
+    def compact(self):
+        light = {key: self.light[key] for key in COMPACT_KEYS if key in self.light}
+        state_keys = self.all.state.keys if self.all.state is not None else None
+        return Profile(self.name, light, state_keys)
+
+
+def light(light_type, modelid, productname, state, **changes):
+    data = copy.deepcopy(ALL)
+    data.update(
+        type=light_type, modelid=modelid, productname=productname, **changes
+    )
+    data["state"] = {key: ALL["state"][key] for key in state}
+    return data
+
+
+PLUG = Profile(
+    "plug",
+    light(
+        "On/Off plug-in unit",
+        "LOM001",
+        "Hue Smart plug",
+        ("on", "alert", "mode", "reachable"),
+        capabilities={
+            "certified": True,
+            "control": {},
+            "streaming": {"renderer": False, "proxy": False},
+        },
+        config={
+            "archetype": "plug",
+            "function": "functional",
+            "direction": "omnidirectional",
+        },
+        swversion="1.65.11_hB798F2BF",
+    ),
+    ("on", "alert", "mode", "reachable"),
+)
+DIMMABLE = Profile(
+    "dimmable",
+    light(
+        "Dimmable light",
+        "LWB010",
+        "Hue white lamp",
+        ("on", "bri", "alert", "mode", "reachable"),
+        capabilities={
+            "certified": True,
+            "control": {"mindimlevel": 5000, "maxlumen": 806},
+            "streaming": {"renderer": False, "proxy": False},
+        },
+        config={
+            "archetype": "classicbulb",
+            "function": "functional",
+            "direction": "omnidirectional",
+        },
+        swversion="1.46.13_r26312",
+    ),
+    ("on", "bri", "alert", "mode", "reachable"),
+)
+# defaults.ALL, with the fast LightState.json()
+EXTENDED = Profile("extended", ALL)
+
+PROFILES = {profile.name: profile for profile in (PLUG, DIMMABLE, EXTENDED)}
+COMPACT = {name: profile.compact() for name, profile in PROFILES.items()}
+
+
+# Profile of a light by its Hue "type", e.g. of a mirrored bridge light
+TYPES = {
+    "on/off plug-in unit": "plug",
+    "on/off light": "plug",
+    "dimmable light": "dimmable",
+}
+
+
+def for_type(light_type):
+    return TYPES.get(str(light_type).lower(), "extended")
+
+
+# compact: the variant with only COMPACT_KEYS, see Hub config COMPACT_LIGHTS
+def get(name, compact=False):
+    try:
+        return (COMPACT if compact else PROFILES)[name]
+    except KeyError:
+        raise ValueError(
+            "Unknown light profile {}, one of {}".format(name, ", ".join(PROFILES))
+        ) from None
+
+
+# Size of the light listing of the devices: number of lights, total bytes
+# and the bytes of the shared static parts, by profile
+def measure(devices, compact=False):
+    sizes = {}
+    for device in devices:
+        profile = get(device.profile, compact)
+        count, total, static = sizes.get(profile.name, (0, 0, 0))
+        sizes[profile.name] = (
+            count + 1,
+            total + len(profile.all.render(device).encode()),
+            static + profile.all.static_size,
+        )
+    return sizes
@@ -0,0 +1,172 @@
+import asyncio
+
+from . import profiles
+from .main import Device
+
+# Reported by the upstream bridge, but not by its lights
+UPSTREAM_ERROR = {"type": 901, "description": "Upstream bridge not reachable"}
+
+
+# Light of an upstream Hue bridge, commands are forwarded as they are (the
+# upstream bridge does the transitions) and the result is applied locally
+class ProxyDevice(Device):
+    def __init__(self, bridge, upstream_id, name, id=None, profile="extended"):
+        super().__init__(name, id=id)
+        self.bridge = bridge
+        self.upstream_id = upstream_id
+        self.profile = profile
+
+    async def set(self, data):
+        results = await self.bridge.command(self.upstream_id, data)
+        # the addresses in the results use the upstream id
+        upstream, local = f"/lights/{self.upstream_id}/", f"/lights/{self.id}/"
+        changes = {}
+        for result in results:
+            if "success" in result:
+                result["success"] = {
+                    address.replace(upstream, local): value
+                    for address, value in result["success"].items()
+                }
+                for address, value in result["success"].items():
+                    key = address.rsplit("/", 1)[-1]
+                    if key in self.STATE_ATTRS:
+                        changes[key] = value
+            elif "address" in result.get("error", {}):
+                address = result["error"]["address"]
+                result["error"]["address"] = address.replace(upstream, local)
+
+        if changes:
+            self.write_state(changes)
+            changes.update(self.sync_color(changes))
+            self.changed(changes, "command")
+        return results
+
+
+# Mirrors the lights of a Hue bridge into the hub. The lights are polled
+# every PROXY_INTERVAL seconds through hub.pool and the differences to the
+# last poll are applied: new, removed and renamed lights in one registry
+# change, state changes with update_state(source="upstream"). The Echos are
+# always answered from the local state.
+class UpstreamBridge:
+    def __init__(self, hub, url, username) -> None:
+        self.hub = hub
+        self.logger = hub.logger
+        self.base = "{}/api/{}".format(url.rstrip("/"), username)
+        # ProxyDevice by upstream light id
+        self.devices = {}
+        # body of the last poll, an unchanged body is not parsed again
+        self.last = None
+        self.reachable = True
+
+    async def run(self):
+        self.logger.info("Mirroring lights of {}".format(self.base))
+        while True:
+            # a bridge must never end the hub's serving tasks
+            try:
+                await self.poll()
+            except Exception:
+                self.logger.exception("Mirroring {} failed".format(self.base))
+                self.set_reachable(False)
+            await asyncio.sleep(self.hub.config["PROXY_INTERVAL"])
+
+    async def poll(self):
+        try:
+            resp = await self.hub.pool.get(self.base + "/lights")
+            if resp.status != 200:
+                raise ConnectionError(f"HTTP {resp.status}")
+        except (OSError, asyncio.TimeoutError) as e:
+            self.logger.error("Polling {} failed: {!r}".format(self.base, e))
+            self.set_reachable(False)
+            return False
+        if resp.body == self.last and self.reachable:
+            return True
+        try:
+            lights = resp.json()
+            if not isinstance(lights, dict):
+                # e.g. [{"error": {"type": 1, ...}}] for an unknown username
+                raise ValueError(lights)
+            self.set_reachable(True)
+            self.update(lights)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.logger.error("Unexpected answer of {}: {!r}".format(self.base, e))
+            self.set_reachable(False)
+            return False
+        self.last = resp.body
+        return True
+
+    # Apply the differences of the polled lights to the hub
+    def update(self, lights):
+        added = []
+        renamed = {}
+        taken = set(self.hub.devices.snapshot())
+        for upstream_id, light in lights.items():
+            device = self.devices.get(upstream_id)
+            if device is None:
+                # the id stays the same when the light is renamed upstream
+                key = "{}#{}".format(self.base, light.get("uniqueid", upstream_id))
+                device = ProxyDevice(
+                    self,
+                    upstream_id,
+                    light["name"],
+                    self.hub.devices.gen_id(key, taken),
+                    profiles.for_type(light.get("type")),
+                )
+                taken.add(device.id)
+                device.init(self.logger, self.hub)
+                self.devices[upstream_id] = device
+                added.append(device)
+            elif device.name != light["name"]:
+                renamed[device.id] = light["name"]
+        removed = [
+            self.devices.pop(upstream_id)
+            for upstream_id in list(self.devices)
+            if upstream_id not in lights
+        ]
+        if added or removed or renamed:
+            self.hub.devices.apply(added, removed, renamed)
+
+        for upstream_id, light in lights.items():
+            device = self.devices[upstream_id]
+            changes = {}
+            # lights are reachable unless the bridge says otherwise
+            state = dict({"reachable": True}, **light.get("state", {}))
+            for key, value in state.items():
+                if key not in device.STATE_ATTRS:
+                    continue
+                if key == "xy" and value is not None:
+                    value = tuple(value)
+                if getattr(device, key) != value:
+                    changes[key] = value
+            if changes:
+                device.update_state("upstream", **changes)
+
+    def set_reachable(self, reachable):
+        if reachable == self.reachable:
+            return
+        self.reachable = reachable
+        if reachable:
+            # the state of this poll is applied, including reachable
+            self.last = None
+            return
+        for device in self.devices.values():
+            if device.reachable:
+                device.update_state("upstream", reachable=False)
+
+    async def command(self, upstream_id, data):
+        url = "{}/lights/{}/state".format(self.base, upstream_id)
+        try:
+            resp = await self.hub.pool.put(url, json=data)
+            results = resp.json()
+            if resp.status != 200 or not isinstance(results, list):
+                raise ConnectionError(f"HTTP {resp.status}")
+            return results
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            self.logger.error("Forwarding to {} failed: {!r}".format(url, e))
+            return [
+                {
+                    "error": dict(
+                        UPSTREAM_ERROR, address=f"/lights/{upstream_id}/state/{key}"
+                    )
+                }
+                for key in data
+            ]
@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+
+# Keeps the state of devices with an on_fetch hook fresh. The device state
+# is the cache, a fetch counts for FETCH_TTL seconds. Stale devices are
+# fetched in the background with at most FETCH_CONCURRENCY fetches at a
+# time, the light listings are answered from the cached state right away.
+class StateRefresher:
+    def __init__(self, config, logger) -> None:
+        self.config = config
+        self.logger = logger
+        # time of the last fetch (successful or not), by device id
+        self.fetched = {}
+        # running fetches by device id, shared by everyone who needs one
+        self.inflight = {}
+        self.semaphore = None
+
+    def stale(self, device):
+        fetched = self.fetched.get(device.id)
+        return fetched is None or time.monotonic() - fetched >= self.config["FETCH_TTL"]
+
+    # Start background fetches for the stale devices, does not wait for them
+    def refresh(self, devices):
+        for device in devices:
+            if device.on_fetch is not None and self.stale(device):
+                self.fetch(device)
+
+    # The running fetch of the device, a new one if none is running.
+    # Await it to get the fetched state changes.
+    def fetch(self, device):
+        task = self.inflight.get(device.id)
+        if task is None:
+            if self.semaphore is None:
+                self.semaphore = asyncio.Semaphore(self.config["FETCH_CONCURRENCY"])
+            task = asyncio.get_running_loop().create_task(self.run(device))
+            self.inflight[device.id] = task
+            task.add_done_callback(lambda task: self.done(device.id, task))
+        return task
+
+    def done(self, device_id, task):
+        if self.inflight.get(device_id) is task:
+            del self.inflight[device_id]
+
+    async def run(self, device):
+        async with self.semaphore:
+            commands = device.commands
+            try:
+                values = await asyncio.wait_for(
+                    device.callback(device.on_fetch), self.config["FETCH_TIMEOUT"]
+                )
+            except Exception as e:
+                self.logger.error(
+                    "Fetching state of {} failed: {!r}".format(device.name, e)
+                )
+                changes = {"reachable": False} if device.reachable else {}
+            else:
+                changes = {}
+                for key, value in (values or {}).items():
+                    if key not in device.STATE_ATTRS:
+                        self.logger.error(
+                            "Fetch of {} returned unknown attribute {}".format(
+                                device.name, key
+                            )
+                        )
+                        continue
+                    if key == "xy" and value is not None:
+                        value = tuple(value)
+                    if getattr(device, key) != value:
+                        changes[key] = value
+                if not device.reachable:
+                    changes["reachable"] = True
+            finally:
+                self.fetched[device.id] = time.monotonic()
+
+        if device.commands != commands:
+            # the backend may not have had the command yet, the state it
+            # returned would undo it. Fetched again on the next poll.
+            self.fetched.pop(device.id, None)
+            return {}
+        # a device that was removed meanwhile is not updated anymore
+        if changes and device.hub is not None and device.id in device.hub.devices:
+            device.update_state("fetch", **changes)
+        return changes
+
+    def forget(self, device_id):
+        self.fetched.pop(device_id, None)
+        task = self.inflight.pop(device_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def stop(self):
+        # bound to the loop of this run
+        self.semaphore = None
+        tasks = list(self.inflight.values())
+        self.inflight.clear()
+        if not tasks:
+            return
+        loop = tasks[0].get_loop()
+        if loop is not asyncio.get_running_loop():
+            # stopped from another thread than the one running the hub
+            for task in tasks:
+                loop.call_soon_threadsafe(task.cancel)
+            return
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
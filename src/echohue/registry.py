@@ -0,0 +1,124 @@
+import hashlib
+import threading
+from collections.abc import Mapping
+
+
+# Immutable view of the registry at one version, handlers iterate this
+# so that a listing never mixes devices from two different versions.
+class Snapshot(Mapping):
+    __slots__ = ("version", "_devices")
+
+    def __init__(self, version, devices):
+        self.version = version
+        self._devices = devices
+
+    def __getitem__(self, device_id):
+        return self._devices[device_id]
+
+    def __iter__(self):
+        return iter(self._devices)
+
+    def __len__(self):
+        return len(self._devices)
+
+
+class DeviceRegistry(Mapping):
+    # Copy on write: readers grab the current snapshot without locking,
+    # writers build a new dict under the lock and swap it in.
+    def __init__(self, logger=None) -> None:
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._snapshot = Snapshot(0, {})
+        self._listeners = []
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def snapshot(self):
+        return self._snapshot
+
+    def __getitem__(self, device_id):
+        return self._snapshot[device_id]
+
+    def __iter__(self):
+        return iter(self._snapshot)
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    # Listeners are called as listener(version, added, removed, renamed)
+    # after every change, from the thread that made the change.
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self._listeners.remove(listener)
+
+    @staticmethod
+    def hash_id(name, attempt=0):
+        if attempt:
+            name = f"{name}#{attempt}"
+        return str(int.from_bytes(hashlib.md5(name.encode()).digest()))[:10]
+
+    def gen_id(self, name, taken):
+        attempt = 0
+        while (device_id := self.hash_id(name, attempt)) in taken:
+            attempt += 1
+        return device_id
+
+    def add(self, *devices):
+        return self.apply(added=devices)
+
+    def remove(self, *devices):
+        return self.apply(removed=devices)
+
+    def rename(self, device_id, name):
+        return self.apply(renamed={device_id: name})
+
+    # Apply a batch of changes as one atomic step (one new version).
+    # removed may contain devices or ids, renamed maps id -> new name.
+    def apply(self, added=(), removed=(), renamed=None):
+        renamed = renamed or {}
+        with self._lock:
+            devices = dict(self._snapshot._devices)
+
+            gone = []
+            for device in removed:
+                device_id = getattr(device, "id", device)
+                if device_id not in devices:
+                    raise KeyError(f"Unknown device id: {device_id}")
+                gone.append(devices.pop(device_id))
+
+            new = []
+            for device in added:
+                if device.id is None:
+                    device.id = self.gen_id(device.name, devices)
+                elif device.id in devices and devices[device.id] is not device:
+                    raise ValueError(
+                        f"Device id {device.id} of {device.name} is already used by {devices[device.id].name}"
+                    )
+                devices[device.id] = device
+                new.append(device)
+
+            for device_id in renamed:
+                if device_id not in devices:
+                    raise KeyError(f"Unknown device id: {device_id}")
+            for device_id, name in renamed.items():
+                devices[device_id].name = name
+
+            if not (gone or new or renamed):
+                return self._snapshot.version
+
+            self._snapshot = Snapshot(self._snapshot.version + 1, devices)
+            version = self._snapshot.version
+
+        if self.logger:
+            self.logger.debug(
+                "Registry v{}: +{} -{} ~{}".format(
+                    version, len(new), len(gone), len(renamed)
+                )
+            )
+        for listener in list(self._listeners):
+            listener(version, new, gone, renamed)
+        return version
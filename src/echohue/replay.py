@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import re
+import socket
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from . import serialize
+from .main import Device, Hub
+from .capture import (
+    DATAGRAM,
+    DATAGRAM_RESPONSE,
+    HTTP_REQUEST,
+    HTTP_RESPONSE,
+    read_capture,
+)
+
+# Replays a capture (see Hub config CAPTURE) against a hub and reports the
+# latencies and the responses that differ from the captured ones.
+#
+#   python -m echohue.replay capture.bin --speed 10
+#
+# Without --target a local hub is started with the identity of the captured
+# hub and the lights of the first captured listing.
+
+# Differ between runs and are not compared
+VOLATILE_HEADERS = (b"date", b"etag", b"last-modified", b"content-length")
+VOLATILE_KEYS = ("lastinstall",)
+# The versions of the replaying hub differ from the captured ones, so
+# conditional requests are sent unconditionally
+CONDITIONAL = re.compile(
+    rb"^(if-none-match|if-modified-since):[^\r\n]*\r\n", re.I | re.M
+)
+
+# kind: "http" or "ssdp", expected: captured response or None
+Exchange = namedtuple("Exchange", ["time", "kind", "request", "expected"])
+
+
+def exchanges(records):
+    responses = {
+        (record.kind, record.id): record.data
+        for record in records
+        if record.kind in (HTTP_RESPONSE, DATAGRAM_RESPONSE)
+    }
+    result = []
+    for record in records:
+        if record.kind == HTTP_REQUEST:
+            expected = responses.get((HTTP_RESPONSE, record.id))
+            result.append(Exchange(record.time, "http", record.data, expected))
+        elif record.kind == DATAGRAM:
+            expected = responses.get((DATAGRAM_RESPONSE, record.id))
+            result.append(Exchange(record.time, "ssdp", record.data, expected))
+    return result
+
+
+def strip_keys(value):
+    if isinstance(value, dict):
+        return {k: strip_keys(v) for k, v in value.items() if k not in VOLATILE_KEYS}
+    if isinstance(value, list):
+        return [strip_keys(v) for v in value]
+    return value
+
+
+# Comparable form of a response: headers without the volatile ones, JSON
+# bodies parsed without the volatile keys
+def normalize(data):
+    head, _, body = data.partition(b"\r\n\r\n")
+    lines = [
+        line
+        for line in head.split(b"\r\n")
+        if line.split(b":", 1)[0].strip().lower() not in VOLATILE_HEADERS
+    ]
+    try:
+        body = strip_keys(serialize.loads(body))
+    except ValueError:
+        pass
+    return lines, body
+
+
+class Report:
+    def __init__(self) -> None:
+        self.latencies = {"http": [], "ssdp": []}
+        self.errors = 0
+        self.compared = 0
+        # (request line, expected, got)
+        self.diffs = []
+        self.duration = 0
+
+    @staticmethod
+    def percentile(values, p):
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def summary(self, diffs=5):
+        lines = ["Replayed in {:.3f}s".format(self.duration)]
+        for kind, latencies in self.latencies.items():
+            if not latencies:
+                continue
+            values = sorted(latencies)
+            p50, p95, p99, top = (
+                self.percentile(values, p) * 1000 for p in (0.5, 0.95, 0.99, 1)
+            )
+            lines.append(
+                "{:5} {:6} requests  p50 {:.2f}ms  p95 {:.2f}ms  "
+                "p99 {:.2f}ms  max {:.2f}ms".format(
+                    kind, len(values), p50, p95, p99, top
+                )
+            )
+        lines.append(
+            "{} errors, {} of {} responses differ".format(
+                self.errors, len(self.diffs), self.compared
+            )
+        )
+        for request, expected, got in self.diffs[:diffs]:
+            lines.append("  {}".format(request))
+            lines.append("    expected: {}".format(expected[:200]))
+            lines.append("    got:      {}".format(got[:200]))
+        return "\n".join(lines)
+
+
+class Replayer:
+    # replace: (captured, replayed) byte strings, e.g. the address of the hub.
+    # Datagrams are sent to the SSDP multicast group like the Echos do, the
+    # responder does not get unicast datagrams to its port.
+    def __init__(
+        self,
+        host,
+        port,
+        upnp_port,
+        timeout=2,
+        concurrency=100,
+        replace=(),
+        ssdp_host="239.255.255.250",
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.upnp_port = upnp_port
+        self.ssdp_host = ssdp_host
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.replace = replace
+
+    # speed: 1 replays in real time, 10 ten times as fast, None as fast as
+    # possible (with at most concurrency requests at a time)
+    async def run(self, records, speed=1):
+        self.report = Report()
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = []
+        start = loop.time()
+        for exchange in exchanges(records):
+            if speed:
+                delay = start + exchange.time / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await semaphore.acquire()
+            task = loop.create_task(self.send(exchange))
+            task.add_done_callback(lambda _: semaphore.release())
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        self.report.duration = loop.time() - start
+        return self.report
+
+    async def send(self, exchange):
+        begin = time.perf_counter()
+        try:
+            if exchange.kind == "http":
+                got = await asyncio.wait_for(self.http(exchange.request), self.timeout)
+            else:
+                got = await self.ssdp(exchange.request, exchange.expected is not None)
+        except (OSError, asyncio.TimeoutError):
+            self.report.errors += 1
+            return
+        self.report.latencies[exchange.kind].append(time.perf_counter() - begin)
+        self.compare(exchange, got)
+
+    async def http(self, request):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(CONDITIONAL.sub(b"", request))
+            await writer.drain()
+            # the hub closes the connection after the response
+            return await reader.read()
+        finally:
+            writer.close()
+
+    async def ssdp(self, datagram, answered):
+        loop = asyncio.get_running_loop()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            await loop.sock_sendto(sock, datagram, (self.ssdp_host, self.upnp_port))
+            if not answered:
+                return None
+            data, _ = await asyncio.wait_for(
+                loop.sock_recvfrom(sock, 4096), self.timeout
+            )
+            return data
+
+    def compare(self, exchange, got):
+        expected = exchange.expected
+        # not modified in the capture, the replay got the full response
+        if expected is None or got is None or expected.startswith(b"HTTP/1.1 304"):
+            return
+        for captured, replayed in self.replace:
+            expected = expected.replace(captured, replayed)
+        self.report.compared += 1
+        if normalize(expected) != normalize(got):
+            request = exchange.request.split(b"\r\n", 1)[0].decode(errors="replace")
+            self.report.diffs.append((request, expected, got))
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Hub with the identity of the captured hub and the lights of the first
+# captured listing, running in a (daemon) thread.
+def start_local_hub(meta, records):
+    hub = Hub()
+    hub.config["IP"] = "127.0.0.1"
+    hub.config["HTTP_PORT"] = free_port()
+    hub.config["UPNP_PORT"] = free_port(socket.SOCK_DGRAM)
+    hub.config["SERIALNO"] = meta["SERIALNO"]
+    hub.config["MACADDRESS"] = meta["MACADDRESS"]
+
+    requests = {r.id: r.data for r in records if r.kind == HTTP_REQUEST}
+    for record in records:
+        if record.kind != HTTP_RESPONSE:
+            continue
+        if not re.match(rb"GET /api/.*lights ", requests.get(record.id, b"")):
+            continue
+        lights = serialize.loads(record.data.partition(b"\r\n\r\n")[2])
+        devices = []
+        for id, light in lights.items():
+            device = Device(light["name"], id=id)
+            devices.append((device, light["state"]))
+        hub.add(*(device for device, _ in devices))
+        for device, state in devices:
+            device.update_state(
+                "replay", **{k: v for k, v in state.items() if k in device.STATE_ATTRS}
+            )
+        break
+
+    thread = threading.Thread(target=lambda: asyncio.run(hub.run()), daemon=True)
+    thread.start()
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", hub.config["HTTP_PORT"]), 1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return hub
+
+
+def stop_local_hub(hub):
+    asyncio.run_coroutine_threadsafe(hub.stop(), hub.event_loop).result(10)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m echohue.replay", description="Replay captured hub traffic"
+    )
+    parser.add_argument("capture", help="file written by a hub with CAPTURE set")
+    parser.add_argument(
+        "--speed", default="1", help="1 for real time, N for N times as fast, max"
+    )
+    parser.add_argument("--target", help="HOST:PORT of a running hub")
+    parser.add_argument("--upnp-port", type=int, default=1900)
+    parser.add_argument("--ssdp-host", default="239.255.255.250")
+    parser.add_argument("--timeout", type=float, default=2)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--diffs", type=int, default=5, help="differences to show")
+    args = parser.parse_args(argv)
+
+    meta, records = read_capture(args.capture)
+    speed = None if args.speed == "max" else float(args.speed)
+
+    hub = None
+    if args.target:
+        host, port = args.target.rsplit(":", 1)
+        port, upnp_port = int(port), args.upnp_port
+    else:
+        hub = start_local_hub(meta, records)
+        host, port = hub.config["IP"], hub.config["HTTP_PORT"]
+        upnp_port = hub.config["UPNP_PORT"]
+
+    captured = "{}:{}".format(meta["IP"], meta["HTTP_PORT"]).encode()
+    replace = [
+        (captured, "{}:{}".format(host, port).encode()),
+        (meta["IP"].encode(), host.encode()),
+    ]
+    replayer = Replayer(
+        host,
+        port,
+        upnp_port,
+        args.timeout,
+        args.concurrency,
+        replace,
+        args.ssdp_host,
+    )
+    try:
+        report = asyncio.run(replayer.run(records, speed))
+    finally:
+        if hub is not None:
+            stop_local_hub(hub)
+    print(report.summary(args.diffs))
+    return 1 if report.errors or report.diffs else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,34 @@
+import json
+
+# JSON backend, the fastest one that is installed. dumps always returns
+# compact utf-8 bytes, loads accepts str and bytes.
+try:
+    import orjson
+
+    BACKEND = "orjson"
+    dumps = orjson.dumps
+    loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        BACKEND = "ujson"
+
+        def dumps(obj):
+            return ujson.dumps(
+                obj, ensure_ascii=False, escape_forward_slashes=False
+            ).encode()
+
+        loads = ujson.loads
+    except ImportError:
+        BACKEND = "json"
+
+        def dumps(obj):
+            return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+        loads = json.loads
+
+
+# Parse a static JSON payload (fails early if it is invalid) and encode it
+def encode_static(text):
+    return dumps(loads(text))
@@ -0,0 +1,118 @@
+import json
+
+from .defaults import ALL, GETSTATE
+
+
+def _encode(value):
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if value is None:
+        return "null"
+    if type(value) is int or type(value) is float:
+        return repr(value)
+    return json.dumps(value)
+
+
+# Light state without a per-instance __dict__. Devices are LightStates
+# themselves, the JSON of the "state" object is written straight from it.
+class LightState:
+    __slots__ = ("on", "bri", "hue", "sat", "xy", "ct", "colormode", "reachable")
+
+    def __init__(
+        self, on=False, bri=1, hue=0, sat=254, xy=(0.0, 0.0), ct=199, colormode="ct"
+    ) -> None:
+        self.on = on
+        self.bri = bri
+        self.hue = hue
+        self.sat = sat
+        self.xy = xy
+        self.ct = ct
+        self.colormode = colormode
+        self.reachable = True
+
+    # Same keys and order as the "state" of defaults.ALL
+    def json(self):
+        xy = self.xy
+        return (
+            '{"on":%s,"bri":%s,"hue":%s,"sat":%s,"effect":"none","xy":%s,'
+            '"ct":%s,"alert":"none","colormode":%s,"mode":"homeautomation",'
+            '"reachable":%s}'
+            % (
+                _encode(self.on),
+                _encode(self.bri),
+                _encode(self.hue),
+                _encode(self.sat),
+                "null" if xy is None else "[%r,%r]" % (xy[0], xy[1]),
+                _encode(self.ct),
+                _encode(self.colormode),
+                _encode(self.reachable),
+            )
+        )
+
+
+# Values of the state keys that are not kept per light
+STATIC_STATE = {"effect": '"none"', "alert": '"none"', "mode": '"homeautomation"'}
+
+
+# JSON of the "state" object with only some of the keys (e.g. no colors for
+# a plug), in the given order. LightState.json() has all of them.
+class StateFormat:
+    def __init__(self, keys) -> None:
+        self.keys = tuple(keys)
+        self.fields = [key for key in self.keys if key not in STATIC_STATE]
+        self.format = "{%s}" % ",".join(
+            '"%s":%s' % (key, STATIC_STATE.get(key, "%s")) for key in self.keys
+        )
+
+    def render(self, state):
+        values = []
+        for key in self.fields:
+            value = getattr(state, key)
+            if key == "xy" and value is not None:
+                values.append("[%r,%r]" % (value[0], value[1]))
+            else:
+                values.append(_encode(value))
+        return self.format % tuple(values)
+
+
+# Pre-rendered JSON of a light template (defaults.ALL or GETSTATE), only
+# the state, name, uniqueid and lastinstall are filled in per light.
+# state: StateFormat of the state keys, all of them if not given.
+class LightTemplate:
+    FIELDS = ("state", "name", "uniqueid", "lastinstall")
+
+    def __init__(self, template, state=None) -> None:
+        self.state = state
+        data = dict(template)
+        data["state"] = "\0state\0"
+        data["name"] = "\0name\0"
+        if "uniqueid" in data:
+            data["uniqueid"] = "\0uniqueid\0"
+        if "swupdate" in data:
+            data["swupdate"] = dict(data["swupdate"], lastinstall="\0lastinstall\0")
+
+        text = json.dumps(data, separators=(",", ":"))
+        text = text.replace("{", "{{").replace("}", "}}")
+        for field in self.FIELDS:
+            text = text.replace(f'"\\u0000{field}\\u0000"', "{%s}" % field)
+        self.format = text.format
+        # bytes every light of this template has, whatever its state
+        self.static_size = len(
+            text.format(state="", name="", uniqueid="", lastinstall="").encode()
+        )
+
+    def render(self, device):
+        return self.format(
+            state=device.state.json()
+            if self.state is None
+            else self.state.render(device.state),
+            name=json.dumps(device.name),
+            uniqueid=json.dumps(device.uniqueid),
+            lastinstall=json.dumps(device.lastinstall),
+        )
+
+
+ALL_TEMPLATE = LightTemplate(ALL)
+GETSTATE_TEMPLATE = LightTemplate(GETSTATE)
@@ -0,0 +1,87 @@
+import asyncio
+import sys
+
+sys.path.insert(0, ".")
+
+from src.echohue import Hub
+from src.echohue.admission import (
+    COMMAND,
+    DISCOVERY,
+    POLL,
+    AdmissionControl,
+    classify,
+)
+
+
+def make_admission(**config):
+    hub = Hub()
+    hub.config.update(config)
+    return AdmissionControl(hub.config, hub.logger)
+
+
+def test_classify():
+    assert classify("PUT /api/echo/lights/3/state HTTP/1.1\r\n") == COMMAND
+    assert classify("GET /api/echo/lights/3 HTTP/1.1\r\n") == POLL
+    assert classify("GET /api/echo/lights HTTP/1.1\r\n") == DISCOVERY
+    assert classify("GET /api/echo HTTP/1.1\r\n") == DISCOVERY
+    assert classify("GET /description.xml HTTP/1.1\r\n") == DISCOVERY
+    assert classify("GET /api/echo/config HTTP/1.1\r\n") == "other"
+
+
+def test_commands_admitted_first():
+    admission = make_admission(ADMISSION_TOTAL=1)
+    order = []
+
+    async def request(cls, client):
+        assert await admission.acquire(cls, client)
+        order.append(cls)
+        await asyncio.sleep(0.01)
+        admission.release(cls, client)
+
+    async def run():
+        first = asyncio.create_task(request(DISCOVERY, "a"))
+        await asyncio.sleep(0)
+        # queued while the first one runs, the command overtakes the others
+        await asyncio.gather(
+            first,
+            request(DISCOVERY, "b"),
+            request(POLL, "c"),
+            request(COMMAND, "d"),
+        )
+
+    asyncio.run(run())
+    assert order == [DISCOVERY, COMMAND, POLL, DISCOVERY]
+    stats = admission.stats()
+    assert stats[COMMAND]["admitted"] == 1 and stats[DISCOVERY]["queued"] == 1
+
+
+def test_discovery_limited_per_client():
+    admission = make_admission(DISCOVERY_PER_CLIENT=2)
+
+    async def run():
+        results = [await admission.acquire(DISCOVERY, "echo") for _ in range(3)]
+        results.append(await admission.acquire(DISCOVERY, "other echo"))
+        admission.release(DISCOVERY, "echo")
+        results.append(await admission.acquire(DISCOVERY, "echo"))
+        return results
+
+    assert asyncio.run(run()) == [True, True, False, True, True]
+    assert admission.stats()[DISCOVERY]["shed_client"] == 1
+
+
+def test_shed_when_queue_full():
+    admission = make_admission(
+        ADMISSION_TOTAL=1, ADMISSION_QUEUE=1, ADMISSION_TIMEOUT=0.05
+    )
+
+    async def run():
+        assert await admission.acquire(COMMAND, "a")
+        waiting = asyncio.create_task(admission.acquire(COMMAND, "b"))
+        await asyncio.sleep(0)
+        shed = await admission.acquire(COMMAND, "c")
+        return shed, await waiting
+
+    assert asyncio.run(run()) == (False, False)
+    stats = admission.stats()[COMMAND]
+    assert stats["shed"] == 1 and stats["shed_timeout"] == 1
+    assert stats["running"] == 1 and stats["waiting"] == 0
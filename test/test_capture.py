@@ -0,0 +1,90 @@
+import asyncio
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, ".")
+
+from src.echohue import Hub, Device
+from src.echohue.capture import (
+    DATAGRAM,
+    DATAGRAM_RESPONSE,
+    HTTP_REQUEST,
+    HTTP_RESPONSE,
+    read_capture,
+)
+from src.echohue.replay import Replayer, start_local_hub, stop_local_hub
+
+M_SEARCH = (
+    b"M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\n"
+    b'MAN: "ssdp:discover"\r\nMX: 3\r\nST: upnp:rootdevice\r\n\r\n'
+)
+
+
+def request(hub, data):
+    with socket.create_connection(("127.0.0.1", hub.config["HTTP_PORT"]), 2) as s:
+        s.sendall(data)
+        resp = b""
+        while chunk := s.recv(65536):
+            resp += chunk
+    return resp
+
+
+def capture(path):
+    hub = Hub()
+    hub.config["IP"] = "127.0.0.1"
+    hub.config["HTTP_PORT"] = 42072
+    hub.config["UPNP_PORT"] = 41902
+    hub.config["CAPTURE"] = str(path)
+    hub.add(Device("Lamp", True, 100, id="1"), Device("Fan", id="2"))
+    thread = threading.Thread(target=lambda: asyncio.run(hub.run()), daemon=True)
+    thread.start()
+    time.sleep(0.3)
+
+    request(hub, b"GET /api/echo/lights HTTP/1.1\r\n\r\n")
+    body = b'{"on": false}'
+    request(
+        hub,
+        b"PUT /api/echo/lights/1/state HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s"
+        % (len(body), body),
+    )
+    request(hub, b"GET /api/echo/lights/1 HTTP/1.1\r\n\r\n")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.settimeout(2)
+        s.sendto(M_SEARCH, ("239.255.255.250", hub.config["UPNP_PORT"]))
+        s.recvfrom(4096)
+
+    asyncio.run_coroutine_threadsafe(hub.stop(), hub.event_loop).result(5)
+
+
+def test_capture_and_replay(tmp_path):
+    path = tmp_path / "echo.cap"
+    capture(path)
+
+    meta, records = read_capture(path)
+    assert meta["SERIALNO"] and meta["HTTP_PORT"] == 42072
+    kinds = [record.kind for record in records]
+    assert kinds.count(HTTP_REQUEST) == kinds.count(HTTP_RESPONSE) == 3
+    assert kinds.count(DATAGRAM) == kinds.count(DATAGRAM_RESPONSE) == 1
+    assert records[0].data.startswith(b"GET /api/echo/lights ")
+    assert [record.time for record in records] == sorted(r.time for r in records)
+
+    hub = start_local_hub(meta, records)
+    try:
+        assert hub.devices["1"].on and hub.devices["1"].bri == 100
+        replayer = Replayer(
+            "127.0.0.1",
+            hub.config["HTTP_PORT"],
+            hub.config["UPNP_PORT"],
+            replace=[(b"42072", str(hub.config["HTTP_PORT"]).encode())],
+        )
+        report = asyncio.run(replayer.run(records, speed=None))
+    finally:
+        stop_local_hub(hub)
+
+    assert report.errors == 0
+    assert report.compared == 4
+    assert report.diffs == []
+    assert len(report.latencies["http"]) == 3
+    assert "responses differ" in report.summary()
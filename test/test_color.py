@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import sys
+
+import pytest
+
+sys.path.insert(0, ".")
+
+from src.echohue import Device, color
+
+
+def test_clip_xy():
+    assert color.in_gamut(color.clip_xy((0.9, 0.9)))
+    inside = (0.4, 0.4)
+    assert color.clip_xy(inside) == inside
+    # red corner of the gamut
+    assert color.clip_xy((0.8, 0.3)) == pytest.approx((0.675, 0.322), abs=1e-3)
+
+
+def test_roundtrips():
+    for rgb in ((255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)):
+        xy = color.rgb_to_xy(rgb)
+        assert color.in_gamut(xy)
+    assert color.rgb_to_hs(color.hs_to_rgb((21845, 254))) == pytest.approx(
+        (21845, 254), abs=200
+    )
+    for ct in (153, 250, 366, 500):
+        assert color.xy_to_ct(color.ct_to_xy(ct)) == pytest.approx(ct, abs=10)
+
+
+def test_convert_many_matches_scalar():
+    values = {
+        "xy": [(0.1, 0.1), (0.4, 0.4), (0.675, 0.322), (0.9, 0.05)],
+        "hs": [(0, 254), (10000, 100), (40000, 254), (65535, 0)],
+        "ct": [153, 200, 366, 500],
+        "rgb": [(255, 0, 0), (12, 200, 30), (0, 0, 0), (255, 255, 255)],
+    }
+    for source in color.SPACES:
+        for target in color.SPACES:
+            scalar = color.convert_many(values[source], source, target, use_numpy=False)
+            if color.np is None:
+                continue
+            batched = color.convert_many(values[source], source, target)
+            for a, b in zip(scalar, batched):
+                assert a == pytest.approx(b, abs=2), (source, target)
+
+
+def test_color_cache():
+    cache = color.ColorCache(size=2)
+    first = cache.convert(366, "ct", "rgb")
+    assert cache.convert(366, "ct", "rgb") is first
+    cache.convert(200, "ct", "rgb")
+    cache.convert(153, "ct", "rgb")
+    assert len(cache.entries) == 2
+
+
+def test_device_sync():
+    device = Device("color")
+    device.init(logging.getLogger("test"))
+    asyncio.run(device.set({"xy": [0.9, 0.9]}))
+    assert device.colormode == "xy"
+    assert color.in_gamut(device.xy)
+    assert device.ct == color.xy_to_ct(device.xy)
+    asyncio.run(device.set({"ct": 500}))
+    assert device.colormode == "ct"
+    assert device.xy == pytest.approx(color.ct_to_xy(500), abs=1e-3)
+    assert device.rgb[0] == 255
+
+
+def test_ct_of_mccamy_pole():
+    device = Device("color")
+    device.init(logging.getLogger("test"))
+    assert asyncio.run(device.set({"xy": [0.4, 0.1858]}))[0].get("success")
+    assert color.CT_MIN <= device.ct <= color.CT_MAX
+    values = [(0.4, 0.1858), (0.4, 0.1859), (0.2, 0.1857), (0.3, 0.1858)]
+    scalar = color.convert_many(values, "xy", "ct", use_numpy=False)
+    assert all(color.CT_MIN <= ct <= color.CT_MAX for ct in scalar)
+    if color.np is not None:
+        assert list(color.convert_many(values, "xy", "ct")) == scalar
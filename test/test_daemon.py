@@ -0,0 +1,77 @@
+import json
+import sys
+
+import pytest
+
+sys.path.insert(0, ".")
+
+from src.echohue import Device
+from src.echohue.daemon import Daemon, validate
+
+
+class Plug(Device):
+    def __init__(self, name, ip="0.0.0.0"):
+        super().__init__(name)
+        self.ip = ip
+
+
+def write(path, devices, hub=None):
+    path.write_text(json.dumps({"hub": hub or {}, "devices": devices}))
+
+
+def test_validate_reports_everything():
+    config = {
+        "hub": {"HTTP_PORT": 8080, "NOPE": 1},
+        "devices": [
+            {"name": "a", "bri": 300},
+            {"id": 5},
+            {"name": "a", "colour": "red"},
+            {"name": "b", "profile": "strip"},
+        ],
+    }
+    with pytest.raises(ValueError) as e:
+        validate(config, {"HTTP_PORT": 80})
+    assert str(e.value).splitlines() == [
+        "hub: unknown key NOPE",
+        "devices[0]: bri must be between 1 and 254",
+        "devices[1]: id must be str",
+        "devices[1]: name is missing",
+        "devices[2]: unknown key colour",
+        "devices[2]: a is defined twice",
+        "devices[3]: profile must be one of plug, dimmable, extended",
+    ]
+
+
+def test_bulk_start(tmp_path):
+    path = tmp_path / "hub.json"
+    write(path, [{"name": f"light {i}", "bri": 100} for i in range(2000)])
+    daemon = Daemon(str(path))
+    daemon.start()
+    assert len(daemon.hub.devices) == 2000
+    # one registry change for all of them
+    assert daemon.hub.devices.version == 1
+    assert all(device.bri == 100 for device in daemon.hub.devices.values())
+
+
+def test_reload_applies_differences(tmp_path):
+    path = tmp_path / "hub.json"
+    plug = {"id": "2", "name": "plug", "class": "test_daemon:Plug"}
+    write(path, [{"id": "1", "name": "lamp"}, plug, {"name": "fan"}])
+    daemon = Daemon(str(path))
+    daemon.start()
+    devices = daemon.hub.devices
+    lamp, old_plug = devices["1"], devices["2"]
+    assert isinstance(old_plug, Plug) and old_plug.ip == "0.0.0.0"
+
+    plug["options"] = {"ip": "10.0.0.5"}
+    write(path, [{"id": "1", "name": "desk lamp"}, plug, {"name": "tv"}])
+    assert daemon.reload()
+    assert devices.version == 2
+    assert devices["1"] is lamp and lamp.name == "desk lamp"
+    assert devices["2"] is not old_plug and devices["2"].ip == "10.0.0.5"
+    assert sorted(d.name for d in devices.values()) == ["desk lamp", "plug", "tv"]
+
+    # an invalid file keeps the running devices
+    write(path, [{"name": "x", "class": "test_daemon:Missing"}])
+    assert not daemon.reload()
+    assert len(devices) == 3 and devices.version == 2
@@ -0,0 +1,132 @@
+import asyncio
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, ".")
+
+from src.echohue import Device, Hub
+from src.echohue.embed import BackgroundHub
+
+
+class SyncLamp(Device):
+    def __init__(self, name):
+        super().__init__(name)
+        self.threads = []
+
+    # a plain, blocking function
+    def on_on(self):
+        time.sleep(0.01)
+        self.threads.append(threading.current_thread().name)
+        return True
+
+
+def make_runner(port):
+    runner = BackgroundHub()
+    runner.hub.config["IP"] = "127.0.0.1"
+    runner.hub.config["HTTP_PORT"] = port
+    runner.hub.config["UPNP_PORT"] = port - 170
+    lamp = SyncLamp("lamp")
+    runner.hub.add(lamp)
+    return runner, lamp
+
+
+def put_on(port, lamp):
+    body = b'{"on": true}'
+    with socket.create_connection(("127.0.0.1", port), 2) as s:
+        s.sendall(
+            b"PUT /api/x/lights/%s/state HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s"
+            % (lamp.id.encode(), len(body), body)
+        )
+        return s.recv(65536)
+
+
+def test_batched_updates_and_sync_callbacks():
+    runner, lamp = make_runner(42074)
+    with runner:
+        assert runner.thread.is_alive()
+
+        def updates(offset):
+            for i in range(200):
+                runner.update_state(lamp.id, bri=offset + i % 50)
+
+        threads = [threading.Thread(target=updates, args=(j,)) for j in (1, 100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        runner.update_state(lamp.id, bri=7, on=True)
+        # applied on the loop
+        for _ in range(100):
+            if lamp.bri == 7:
+                break
+            time.sleep(0.01)
+        assert lamp.bri == 7 and lamp.on
+        # 401 updates, far fewer wakeups of the loop
+        assert runner.wakeups < 100
+
+        lamp.on = False
+        assert b"success" in put_on(42074, lamp)
+        assert lamp.on
+        assert lamp.threads and lamp.threads[0].startswith("echohue")
+
+    assert runner.thread is None
+
+
+def test_awaitable_callbacks():
+    calls = []
+
+    class Callable:
+        async def __call__(self, value):
+            calls.append(("call", value))
+            return True
+
+    async def off():
+        calls.append(("off",))
+        return False
+
+    hub = Hub()
+    lamp = Device("lamp")
+    hub.add(lamp)
+    lamp.on_bri = Callable()
+    lamp.on_off = lambda: off()
+
+    async def main():
+        assert await lamp.set_bri(50)
+        lamp.on = True
+        assert not await lamp.set_off()
+
+    asyncio.run(main())
+    hub.executor.shutdown()
+    assert calls == [("call", 50), ("off",)]
+    assert lamp.bri == 50 and lamp.on
+
+
+def test_update_after_stop():
+    runner, lamp = make_runner(42076)
+    runner.start()
+    assert b"success" in put_on(42076, lamp)
+    runner.stop()
+    runner.update_state(lamp.id, bri=42)
+    assert runner.pending and not runner.scheduled
+    runner.start()
+    try:
+        for _ in range(100):
+            if lamp.bri == 42:
+                break
+            time.sleep(0.01)
+        assert lamp.bri == 42
+        runner.update_state(lamp.id, bri=43)
+        for _ in range(100):
+            if lamp.bri == 43:
+                break
+            time.sleep(0.01)
+        assert lamp.bri == 43
+        # the hub serves again, with a new executor
+        assert runner.hub.serving.is_set()
+        lamp.on = False
+        assert b"success" in put_on(42076, lamp)
+        assert lamp.on and len(lamp.threads) == 2
+    finally:
+        runner.stop()
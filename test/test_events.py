@@ -0,0 +1,86 @@
+import asyncio
+import sys
+import threading
+
+sys.path.insert(0, ".")
+
+from src.echohue import Hub, Device
+
+
+def make_hub():
+    hub = Hub()
+    device = Device("events", id="1")
+    hub.add(device)
+    return hub, device
+
+
+def test_command_event():
+    hub, device = make_hub()
+
+    async def run():
+        with hub.subscribe() as subscription:
+            await device.set({"on": True, "bri": 100})
+            return await subscription.batch()
+
+    events = asyncio.run(run())
+    assert len(events) == 1
+    assert events[0].device_id == "1"
+    assert events[0].changes == {"on": True, "bri": 100}
+    assert events[0].source == "command"
+
+
+def test_update_state_invalidates_cache():
+    hub, device = make_hub()
+    device.cache["all"] = "stale"
+
+    async def run():
+        subscription = hub.subscribe(device_ids=["1"])
+        hub.update_state("1", on=True, bri=20)
+        return await subscription.__anext__()
+
+    event = asyncio.run(run())
+    assert event.changes == {"on": True, "bri": 20}
+    assert event.source == "external"
+    assert device.bri == 20
+    assert device.cache == {}
+
+
+def test_attribute_assignment_invalidates_cache():
+    hub, device = make_hub()
+    device.on = True
+    device.cache["all"] = b"stale"
+    version = hub.state.bump()
+    device.on = False
+    device.xy = [0.3, 0.3]
+    assert device.cache == {}
+    assert hub.state.version > version
+    assert device.state.xy == (0.3, 0.3)
+
+
+def test_update_state_from_thread():
+    hub, device = make_hub()
+
+    async def run():
+        hub.events.event_loop = asyncio.get_running_loop()
+        subscription = hub.subscribe()
+        thread = threading.Thread(target=lambda: device.update_state(on=True))
+        thread.start()
+        thread.join()
+        return await asyncio.wait_for(subscription.batch(), 1)
+
+    events = asyncio.run(run())
+    assert events[0].changes == {"on": True}
+
+
+def test_slow_subscriber_drops_oldest():
+    hub, device = make_hub()
+
+    async def run():
+        subscription = hub.subscribe(maxsize=2)
+        for bri in (1, 2, 3):
+            device.update_state(bri=bri)
+        return subscription, await subscription.batch()
+
+    subscription, events = asyncio.run(run())
+    assert [event.changes["bri"] for event in events] == [2, 3]
+    assert subscription.dropped == 1
@@ -0,0 +1,76 @@
+import asyncio
+import sys
+
+sys.path.insert(0, ".")
+
+from src.echohue import Hub, Device
+
+
+class Recorder(Device):
+    def __init__(self, name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.frames = []
+
+    async def on_bri(self, value):
+        self.frames.append(value)
+
+
+def make_hub(count=1):
+    hub = Hub()
+    hub.config["FADE_MAX_RATE"] = 50
+    devices = [Recorder(f"fade {i}", bri=1) for i in range(count)]
+    hub.add(*devices)
+    return hub, devices
+
+
+def test_transitiontime_fades():
+    hub, (device,) = make_hub()
+
+    async def run():
+        result = await device.set({"bri": 201, "transitiontime": 2})
+        assert device.bri == 1
+        await hub.fader.task
+        return result
+
+    result = asyncio.run(run())
+    assert {"success": {f"/lights/{device.id}/state/bri": 201}} in result
+    assert {"success": {f"/lights/{device.id}/state/transitiontime": 2}} in result
+    assert device.bri == 201
+    assert 3 <= len(device.frames) <= 12
+    assert device.frames == sorted(device.frames)
+
+
+def test_shared_tick():
+    hub, devices = make_hub(20)
+
+    async def run():
+        for device in devices:
+            await device.set({"bri": 100, "transitiontime": 1})
+        # one scheduler task for all fades
+        assert len(hub.fader.fades) == 20
+        await hub.fader.task
+
+    asyncio.run(run())
+    assert all(device.bri == 100 for device in devices)
+    assert not hub.fader.fades
+
+
+def test_new_command_cancels_fade():
+    hub, (device,) = make_hub()
+
+    async def run():
+        await device.set({"bri": 254, "transitiontime": 50})
+        await asyncio.sleep(0.05)
+        await device.set({"bri": 10})
+        await asyncio.sleep(0.05)
+        return device.bri
+
+    assert asyncio.run(run()) == 10
+    assert not hub.fader.fades
+
+
+def test_zero_transitiontime():
+    hub, (device,) = make_hub()
+    asyncio.run(device.set({"bri": 50, "transitiontime": 0}))
+    assert device.bri == 50
+    assert hub.fader.task is None
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, ".")
+
+from src.echohue import Hub, Device, main
+
+PORT = 42070
+
+
+def make_hub(path):
+    hub = Hub()
+    hub.config["IP"] = "127.0.0.1"
+    hub.config["HTTP_PORT"] = PORT
+    hub.config["UPNP_PORT"] = 41900
+    hub.config["HANDOFF_PATH"] = path
+    hub.add(Device("handoff", id="1"))
+    return hub
+
+
+def start(hub, **kwargs):
+    thread = threading.Thread(
+        target=lambda: asyncio.run(hub.run(**kwargs)), daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def get(path=b"/api/user/lights"):
+    with socket.create_connection(("127.0.0.1", PORT), 1) as s:
+        s.sendall(b"GET %s HTTP/1.1\r\n\r\n" % path)
+        resp = b""
+        while chunk := s.recv(65536):
+            resp += chunk
+    return resp.partition(b"\r\n\r\n")
+
+
+def get_lights():
+    return json.loads(get()[2])
+
+
+def get_etag():
+    headers = get()[0].split(b"\r\n")
+    return [h for h in headers if h.startswith(b"ETAG:")][0][6:]
+
+
+def wait_for(check, timeout=5):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            if check():
+                return True
+        except OSError:
+            pass
+        time.sleep(0.05)
+    return False
+
+
+def test_handoff(tmp_path):
+    path = str(tmp_path / "hub.sock")
+    old = make_hub(path)
+    old_thread = start(old)
+    assert wait_for(lambda: get_lights() and os.path.exists(path))
+    lights = get_lights()
+    etag = get_etag()
+
+    new = make_hub(path)
+    new.devices["1"].name = "new"
+    new_thread = start(new, takeover=True)
+
+    # keep polling through the handoff, no request may be refused
+    polled = []
+    while old_thread.is_alive():
+        polled.append(get_lights()["1"]["name"])
+        assert len(polled) < 500
+    old_thread.join()
+
+    assert wait_for(lambda: get_lights()["1"]["name"] == "new")
+    assert new.config["SERIALNO"] == old.config["SERIALNO"]
+    assert get_lights()["1"]["uniqueid"] == lights["1"]["uniqueid"]
+    # same serial, new state versions: a cached ETag must not match
+    assert get_etag() != etag
+    assert new_thread.is_alive()
+    # the new hub accepts the next handoff
+    assert wait_for(lambda: os.path.exists(path))
+    asyncio.run(asyncio.wait_for(new.stop(), timeout=2))
+
+
+def test_inherited_ssdp_socket_joins_group(monkeypatch):
+    # bound by "systemd", without the multicast membership
+    ssdp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    ssdp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    ssdp.bind(("", 41902))
+    monkeypatch.setattr(main, "inherited_sockets", lambda: {"ssdp": ssdp})
+    hub = Hub()
+    hub.config["IP"] = "127.0.0.1"
+    hub.config["HTTP_PORT"] = PORT + 1
+    hub.config["UPNP_PORT"] = 41902
+    start(hub)
+    assert wait_for(lambda: hub.serving.is_set())
+
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    client.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    client.settimeout(0.5)
+    search = (
+        b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"'
+        b"\r\nMX: 1\r\nST: upnp:rootdevice\r\n\r\n"
+    )
+    try:
+
+        def answered():
+            client.sendto(search, ("239.255.255.250", 41902))
+            try:
+                return b"200 OK" in client.recv(4096)
+            except socket.timeout:
+                return False
+
+        assert wait_for(answered, timeout=3)
+    finally:
+        client.close()
+        asyncio.run(asyncio.wait_for(hub.stop(), timeout=2))
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import sys
+
+sys.path.insert(0, ".")
+
+from src.echohue import Hub
+
+
+# Stand-in backend: answers every request with the request line as JSON,
+# "/close" closes the connection after the response. The next drop requests
+# are answered by closing the connection.
+class Backend:
+    def __init__(self):
+        self.connections = 0
+        self.drop = 0
+        self.requests = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return "http://127.0.0.1:{}".format(self.server.sockets[0].getsockname()[1])
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while head := await reader.readuntil(b"\r\n\r\n"):
+                line = head.split(b"\r\n")[0].decode()
+                length = 0
+                for header in head.split(b"\r\n"):
+                    if header.lower().startswith(b"content-length:"):
+                        length = int(header.split(b":")[1])
+                body = await reader.readexactly(length)
+                self.requests.append((line, body))
+                if self.drop:
+                    self.drop -= 1
+                    break
+                resp = json.dumps({"line": line}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n%s\r\n%s"
+                    % (
+                        len(resp),
+                        b"Connection: close\r\n" if "/close" in line else b"",
+                        resp,
+                    )
+                )
+                await writer.drain()
+                if "/close" in line:
+                    break
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+
+    def stop(self):
+        self.server.close()
+
+
+def run(test):
+    hub = Hub()
+    hub.config["POOL_BACKOFF"] = 0.01
+    backend = Backend()
+
+    async def main():
+        url = await backend.start()
+        try:
+            return await test(hub, backend, url)
+        finally:
+            await hub.pool.close()
+            backend.stop()
+
+    return asyncio.run(main()), backend
+
+
+def test_keep_alive():
+    async def test(hub, backend, url):
+        for i in range(5):
+            resp = await hub.pool.put(url + "/light", json={"on": True})
+            assert resp.status == 200
+        return resp.json()
+
+    result, backend = run(test)
+    assert result == {"line": "PUT /light HTTP/1.1"}
+    assert backend.connections == 1
+    assert backend.requests[0][1] == b'{"on":true}'
+
+
+def test_pool_size_limit():
+    async def test(hub, backend, url):
+        hub.config["POOL_SIZE"] = 3
+        await asyncio.gather(*(hub.pool.get(url + "/x") for i in range(20)))
+        (pool,) = hub.pool.pools.values()
+        return len(pool.idle)
+
+    idle, backend = run(test)
+    assert len(backend.requests) == 20
+    assert backend.connections == idle == 3
+
+
+def test_connection_close_and_retry():
+    async def test(hub, backend, url):
+        await hub.pool.get(url + "/close")
+        # the backend drops the next request without an answer, GET is retried
+        backend.drop = 1
+        return await hub.pool.get(url + "/x")
+
+    resp, backend = run(test)
+    assert resp.status == 200
+    assert backend.connections == 3
+    assert [line for line, _ in backend.requests][-2:] == ["GET /x HTTP/1.1"] * 2
+
+
+def test_post_is_not_retried():
+    async def test(hub, backend, url):
+        backend.drop = 1
+        try:
+            await hub.pool.post(url + "/x", b"data")
+        except ConnectionError:
+            return True
+
+    failed, backend = run(test)
+    assert failed
+    assert len(backend.requests) == 1
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import logging
+import sys
+
+import pytest
+
+sys.path.insert(0, ".")
+
+from src.echohue import Device
+from src.echohue import profiles
+from src.echohue.main import Httpd, Hub
+
+
+def make_device(name, profile):
+    device = Device(name, True, 120)
+    device.profile = profile
+    device.init(logging.getLogger("test"))
+    device.xy = (0.3, 0.4)
+    return device
+
+
+def test_profile_state_keys():
+    plug = json.loads(profiles.get("plug").all.render(make_device("Plug", "plug")))
+    assert plug["type"] == "On/Off plug-in unit"
+    assert plug["state"] == {
+        "on": True,
+        "alert": "none",
+        "mode": "homeautomation",
+        "reachable": True,
+    }
+    lamp = make_device("Lamp", "dimmable")
+    state = json.loads(profiles.get("dimmable").getstate.render(lamp))["state"]
+    assert state["bri"] == 120 and "xy" not in state
+    lamp = make_device("Lamp", "extended")
+    state = json.loads(profiles.get("extended").all.render(lamp))["state"]
+    assert state["xy"] == [0.3, 0.4]
+
+
+def test_compact_is_smaller():
+    device = make_device('Lamp "1"', "extended")
+    for name in profiles.PROFILES:
+        full = profiles.get(name).all.render(device)
+        compact = profiles.get(name, compact=True).all.render(device)
+        assert len(compact) < len(full) / 2
+        assert json.loads(compact)["name"] == 'Lamp "1"'
+    with pytest.raises(ValueError):
+        profiles.get("strip")
+
+
+def test_listing_grows_with_state_only():
+    devices = [make_device("Lamp", "plug") for _ in range(3)]
+    devices[1].name = "A much longer lamp name"
+    sizes = profiles.measure(devices)
+    count, total, static = sizes["plug"]
+    assert count == 3
+    assert static == 3 * profiles.PLUG.all.static_size
+    dynamic = sum(
+        len(json.dumps(d.name)) + len(json.dumps(d.uniqueid)) for d in devices
+    )
+    assert total - static > dynamic
+
+
+def test_hub_serves_profiles():
+    hub = Hub()
+    hub.config["COMPACT_LIGHTS"] = True
+    plug = Device("Plug")
+    plug.profile = "plug"
+    hub.add(plug, Device("Lamp"))
+
+    async def listing():
+        httpd = Httpd(hub.devices, None, hub.config, None, hub.logger)
+        assert httpd.prerender()[0] == 2
+        return await httpd.get_lights_json(hub.devices)
+
+    lights = json.loads(b"{%s}" % asyncio.run(listing()))
+    assert lights[plug.id]["state"]["on"] is False
+    assert "bri" not in lights[plug.id]["state"]
+    assert "capabilities" not in lights[plug.id]
+    bad = Device("Strip")
+    bad.profile = "strip"
+    with pytest.raises(ValueError):
+        hub.add(bad)
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import sys
+
+sys.path.insert(0, ".")
+
+from src.echohue import Hub
+
+
+# Stand-in Hue bridge with the API of user "echo"
+class FakeBridge:
+    def __init__(self):
+        self.lights = {
+            "1": {"name": "Hall", "state": {"on": True, "bri": 200, "reachable": True}},
+            "2": {
+                "name": "Desk",
+                "type": "Dimmable light",
+                "state": {"on": False, "bri": 10, "reachable": True},
+            },
+        }
+        self.commands = []
+        # raw body of the light listing instead of the lights
+        self.raw = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return "http://127.0.0.1:{}".format(self.server.sockets[0].getsockname()[1])
+
+    async def handle(self, reader, writer):
+        try:
+            while head := await reader.readuntil(b"\r\n\r\n"):
+                method, path = head.decode().split(" ")[:2]
+                length = 0
+                for line in head.decode().split("\r\n"):
+                    if line.lower().startswith("content-length:"):
+                        length = int(line.split(":")[1])
+                body = await reader.readexactly(length)
+                if method == "GET" and path == "/api/echo/lights":
+                    resp = self.lights
+                else:
+                    light = path.split("/")[4]
+                    data = json.loads(body)
+                    self.commands.append((light, data))
+                    self.lights[light]["state"].update(data)
+                    resp = [
+                        {"success": {f"/lights/{light}/state/{key}": value}}
+                        for key, value in data.items()
+                    ]
+                resp = json.dumps(resp).encode() if self.raw is None else self.raw
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s"
+                    % (len(resp), resp)
+                )
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+
+
+def run(test):
+    hub = Hub()
+    fake = FakeBridge()
+
+    async def main():
+        url = await fake.start()
+        bridge = hub.mirror(url, "echo")
+        try:
+            return await test(hub, fake, bridge)
+        finally:
+            await hub.pool.close()
+            fake.server.close()
+
+    return asyncio.run(main())
+
+
+def test_mirror_and_diff():
+    async def test(hub, fake, bridge):
+        assert await bridge.poll()
+        version = hub.devices.version
+        hall = bridge.devices["1"]
+        assert hub.devices[hall.id] is hall and hall.bri == 200 and hall.on
+
+        fake.lights["1"]["name"] = "Hallway"
+        fake.lights["1"]["state"]["bri"] = 100
+        del fake.lights["2"]
+        fake.lights["3"] = {"name": "Porch", "state": {"on": True, "bri": 1}}
+        with hub.subscribe() as events:
+            assert await bridge.poll()
+            changes = await events.batch()
+        # one registry change for the added, removed and renamed lights
+        assert hub.devices.version == version + 1
+        assert sorted(d.name for d in hub.devices.values()) == ["Hallway", "Porch"]
+        assert hall.bri == 100
+        assert {"device_id": hall.id, "changes": {"bri": 100}}.items() <= (
+            changes[0]._asdict().items()
+        )
+
+    run(test)
+
+
+def test_command_forwarded():
+    async def test(hub, fake, bridge):
+        await bridge.poll()
+        desk = bridge.devices["2"]
+        result = await desk.set({"on": True, "bri": 254})
+        return desk, fake.commands, result
+
+    desk, commands, result = run(test)
+    assert commands == [("2", {"on": True, "bri": 254})]
+    assert {"success": {f"/lights/{desk.id}/state/on": True}} in result
+    assert desk.on and desk.bri == 254
+
+
+def test_upstream_down():
+    async def test(hub, fake, bridge):
+        await bridge.poll()
+        fake.server.close()
+        await fake.server.wait_closed()
+        await hub.pool.close()
+        hub.config["POOL_RETRIES"] = 0
+        assert not await bridge.poll()
+        hall = bridge.devices["1"]
+        result = await hall.set({"on": False})
+        return hall, result
+
+    hall, result = run(test)
+    assert not hall.reachable and hall.on
+    assert result[0]["error"]["address"] == f"/lights/{hall.id}/state/on"
+
+
+def test_bad_upstream_answer():
+    async def test(hub, fake, bridge):
+        await bridge.poll()
+        hall = bridge.devices["1"]
+        fake.raw = b"<html>Bad gateway</html>"
+        assert not await bridge.poll()
+        assert not hall.reachable
+        fake.raw = b'{"1": {"state": {}}}'
+        assert not await bridge.poll()
+
+        hub.config["PROXY_INTERVAL"] = 0.01
+        task = asyncio.create_task(bridge.run())
+        await asyncio.sleep(0.05)
+        assert not task.done()
+        fake.raw = None
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return hall
+
+    hall = run(test)
+    assert hall.reachable
+
+
+def test_stable_ids_and_profiles():
+    async def test(hub, fake, bridge):
+        await bridge.poll()
+        ids = {key: device.id for key, device in bridge.devices.items()}
+        profiles = {key: device.profile for key, device in bridge.devices.items()}
+        # after a restart, with the light renamed upstream meanwhile
+        fake.lights["1"]["name"] = "Hallway"
+        other = Hub()
+        again = other.mirror(bridge.base.rsplit("/api/", 1)[0], "echo")
+        try:
+            await again.poll()
+        finally:
+            await other.pool.close()
+        return ids, profiles, {k: d.id for k, d in again.devices.items()}
+
+    ids, profiles, again = run(test)
+    assert ids == again
+    assert profiles == {"1": "extended", "2": "dimmable"}
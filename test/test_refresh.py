@@ -0,0 +1,115 @@
+import asyncio
+import sys
+
+sys.path.insert(0, ".")
+
+from src.echohue import Hub, Device
+
+
+class Backend(Device):
+    running = 0
+    peak = 0
+
+    def __init__(self, name, **kwargs):
+        super().__init__(name, **kwargs)
+        self.fetches = 0
+        self.fail = False
+
+    async def on_fetch(self):
+        self.fetches += 1
+        Backend.running += 1
+        Backend.peak = max(Backend.peak, Backend.running)
+        try:
+            await asyncio.sleep(0.01)
+            if self.fail:
+                raise ConnectionError("backend down")
+            return {"on": True, "bri": 77, "xy": [0.3, 0.3]}
+        finally:
+            Backend.running -= 1
+
+
+def make_hub(count=1):
+    hub = Hub()
+    hub.config["FETCH_CONCURRENCY"] = 4
+    devices = [Backend(f"backend {i}") for i in range(count)]
+    hub.add(*devices)
+    return hub, devices
+
+
+def test_fetch_updates_state():
+    hub, (device,) = make_hub()
+    version = hub.state.version
+
+    async def run():
+        with hub.subscribe() as events:
+            changes = await hub.fetch(device.id)
+            # unchanged state does not publish again
+            hub.refresher.fetched.clear()
+            assert await hub.fetch(device.id) == {}
+            return changes, await events.batch()
+
+    changes, events = asyncio.run(run())
+    assert changes == {"on": True, "bri": 77, "xy": (0.3, 0.3)}
+    assert device.on and device.bri == 77
+    assert [event.source for event in events] == ["fetch"]
+    assert hub.state.version > version
+
+
+def test_shared_fetch_and_ttl():
+    hub, (device,) = make_hub()
+
+    async def run():
+        first = hub.refresher.fetch(device)
+        assert hub.refresher.fetch(device) is first
+        await first
+        hub.refresher.refresh([device])
+        assert not hub.refresher.inflight
+
+    asyncio.run(run())
+    assert device.fetches == 1
+
+
+def test_bounded_background_refresh():
+    hub, devices = make_hub(40)
+    Backend.peak = 0
+
+    async def run():
+        # returns right away, the fetches run in the background
+        hub.refresher.refresh(devices)
+        assert all(device.fetches == 0 for device in devices)
+        await asyncio.gather(*hub.refresher.inflight.values())
+
+    asyncio.run(run())
+    assert all(device.fetches == 1 and device.bri == 77 for device in devices)
+    assert Backend.peak == 4
+
+
+def test_failure_marks_unreachable():
+    hub, (device,) = make_hub()
+    device.fail = True
+
+    async def run():
+        await hub.fetch(device.id)
+        assert not device.reachable
+        device.fail = False
+        hub.refresher.fetched.clear()
+        await hub.fetch(device.id)
+
+    asyncio.run(run())
+    assert device.reachable
+
+
+def test_command_during_fetch_wins():
+    hub, (device,) = make_hub()
+
+    async def run():
+        fetch = hub.refresher.fetch(device)
+        await asyncio.sleep(0)
+        # the backend still reports bri 77 while this command is applied
+        await device.set({"bri": 200})
+        changes = await fetch
+        return changes, hub.refresher.stale(device)
+
+    changes, stale = asyncio.run(run())
+    assert changes == {} and stale
+    assert device.bri == 200 and not device.on
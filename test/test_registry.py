@@ -0,0 +1,64 @@
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, ".")
+
+from src.echohue import Device, DeviceRegistry
+
+
+def test_colliding_ids():
+    registry = DeviceRegistry()
+    a = Device("lamp")
+    b = Device("other", id=DeviceRegistry.hash_id("lamp"))
+    registry.add(b)
+    registry.add(a)
+    assert a.id != b.id
+    assert a.id == DeviceRegistry.hash_id("lamp", 1)
+    assert len(registry) == 2
+
+
+def test_explicit_id_collision():
+    registry = DeviceRegistry()
+    registry.add(Device("a", id="1"))
+    with pytest.raises(ValueError):
+        registry.add(Device("b", id="1"))
+    assert len(registry) == 1
+
+
+def test_snapshot_is_stable():
+    registry = DeviceRegistry()
+    registry.add(Device("a"), Device("b"))
+    snapshot = registry.snapshot()
+    registry.remove(next(iter(snapshot)))
+    assert len(snapshot) == 2
+    assert len(registry) == 1
+    assert registry.version == snapshot.version + 1
+
+
+def test_apply_and_listeners():
+    registry = DeviceRegistry()
+    changes = []
+    registry.subscribe(lambda *args: changes.append(args))
+    a, b = Device("a"), Device("b", id="2")
+    registry.add(a)
+    version = registry.apply(added=[b], removed=[a.id], renamed={b.id: "c"})
+    assert version == 2
+    assert list(registry) == [b.id]
+    assert b.name == "c"
+    assert changes[-1] == (2, [b], [a], {b.id: "c"})
+
+
+def test_concurrent_add():
+    registry = DeviceRegistry()
+    threads = [
+        threading.Thread(target=lambda i=i: registry.add(Device(f"d{i}")))
+        for i in range(50)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(registry) == 50
+    assert registry.version == 50
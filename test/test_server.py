@@ -1,5 +1,6 @@
 
 import asyncio, pytest
+import json
 import socket
 import time, sys
 import threading
@@ -62,5 +63,68 @@ def test_Httpd():
     assert r == b"ok"
 
 
+def request(data):
+    with socket.create_connection((hub.config["IP"], hub.config["HTTP_PORT"]), 1) as s:
+        s.sendall(data)
+        resp = b""
+        while chunk := s.recv(65536):
+            resp += chunk
+    return resp.partition(b"\r\n\r\n")
+
+
+def test_lights():
+    headers, _, body = request(b"GET /api/user/lights HTTP/1.1\r\n\r\n")
+    assert b"CONTENT-LENGTH: %d" % len(body) in headers
+    lights = json.loads(body)
+    assert lights[device.id]["name"] == "test"
+
+
+def test_api():
+    _, _, body = request(b"GET /api/user HTTP/1.1\r\n\r\n")
+    state = json.loads(body)
+    assert device.id in state["lights"]
+    assert state["config"]["mac"] == hub.config["MACADDRESS"]
+
+
+def test_api_config():
+    _, _, body = request(b"GET /api/user/config HTTP/1.1\r\n\r\n")
+    assert json.loads(body)[0]["mac"] == hub.config["MACADDRESS"]
+
+
+def test_put_state():
+    content = b'{"on": true, "bri": 100}'
+    headers, _, body = request(
+        b"PUT /api/user/lights/%s/state HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s"
+        % (device.id.encode(), len(content), content)
+    )
+    assert {"success": {f"/lights/{device.id}/state/bri": 100}} in json.loads(body)
+    assert device.bri == 100
+
+
+def test_conditional_get():
+    headers, _, body = request(b"GET /api/user/lights HTTP/1.1\r\n\r\n")
+    etag = [h for h in headers.split(b"\r\n") if h.startswith(b"ETAG:")][0][6:]
+    headers, _, body = request(
+        b"GET /api/user/lights HTTP/1.1\r\nIf-None-Match: %s\r\n\r\n" % etag
+    )
+    assert headers.startswith(b"HTTP/1.1 304")
+    assert body == b""
+    device.update_state(bri=5)
+    headers, _, body = request(
+        b"GET /api/user/lights HTTP/1.1\r\nIf-None-Match: %s\r\n\r\n" % etag
+    )
+    assert headers.startswith(b"HTTP/1.1 200")
+    assert json.loads(body)[device.id]["state"]["bri"] == 5
+
+
+def test_if_modified_since():
+    hub.state.modified -= 10
+    headers, _, _ = request(b"GET /api/user/lights HTTP/1.1\r\n\r\n")
+    modified = [h for h in headers.split(b"\r\n") if h.startswith(b"LAST-MODIFIED:")][0][15:]
+    headers, _, _ = request(
+        b"GET /api/user/lights HTTP/1.1\r\nIf-Modified-Since: %s\r\n\r\n" % modified
+    )
+    assert headers.startswith(b"HTTP/1.1 304")
+
 def test_stop_hub():
     asyncio.run(asyncio.wait_for(hub.stop(), timeout=2))
\ No newline at end of file
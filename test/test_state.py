@@ -0,0 +1,60 @@
+import copy
+import json
+import logging
+import sys
+import tracemalloc
+
+sys.path.insert(0, ".")
+
+from src.echohue import Device, Hub
+from src.echohue.defaults import ALL, GETSTATE
+from src.echohue.state import ALL_TEMPLATE, GETSTATE_TEMPLATE, LightState
+
+
+def make_device():
+    device = Device('Lamp "1"', True, 200)
+    device.init(logging.getLogger("test"))
+    device.xy = [0.3, 0.4]
+    return device
+
+
+def expected(device, template):
+    data = copy.deepcopy(template)
+    for key in data["state"]:
+        if key in LightState.__slots__:
+            data["state"][key] = getattr(device, key)
+    data["state"]["xy"] = list(device.xy)
+    data["name"] = device.name
+    data["swupdate"]["lastinstall"] = device.lastinstall
+    if "uniqueid" in data:
+        data["uniqueid"] = device.uniqueid
+    return data
+
+
+def test_render_matches_template():
+    device = make_device()
+    assert json.loads(ALL_TEMPLATE.render(device)) == expected(device, ALL)
+    assert json.loads(GETSTATE_TEMPLATE.render(device)) == expected(device, GETSTATE)
+
+
+def test_compact_state():
+    device = make_device()
+    assert device.state is device and isinstance(device, LightState)
+    assert device.state.xy == (0.3, 0.4)
+    device.bri = 10
+    assert device.state.bri == 10
+
+
+def test_device_memory():
+    hub = Hub()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        devices = [Device(f"light {i}", True, 100) for i in range(2000)]
+        hub.add(*devices)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    # devices with a __dict__ per instance took about 380 bytes each
+    assert size / len(devices) < 370